@@ -0,0 +1 @@
+DROP TABLE sync_state;
\ No newline at end of file
@@ -0,0 +1,7 @@
+CREATE TABLE sync_state (
+    event_slug VARCHAR(255) PRIMARY KEY,
+    last_synced_at TIMESTAMPTZ NOT NULL,
+    last_changed_at TIMESTAMPTZ NOT NULL,
+    project_count INTEGER NOT NULL,
+    digest VARCHAR(64) NOT NULL
+);
@@ -0,0 +1 @@
+DROP TABLE project_digest;
\ No newline at end of file
@@ -0,0 +1,4 @@
+CREATE TABLE project_digest (
+    project_uuid VARCHAR(255) PRIMARY KEY REFERENCES project(uuid) ON DELETE CASCADE,
+    media_digest VARCHAR(64)
+);
@@ -0,0 +1,7 @@
+DROP INDEX project_digest_generation_idx;
+
+ALTER TABLE project_digest
+    DROP COLUMN content_hash,
+    DROP COLUMN generation;
+
+DROP TABLE ingest_run;
\ No newline at end of file
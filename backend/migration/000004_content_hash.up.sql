@@ -0,0 +1,11 @@
+CREATE TABLE ingest_run (
+    generation BIGSERIAL PRIMARY KEY,
+    started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    finished_at TIMESTAMPTZ
+);
+
+ALTER TABLE project_digest
+    ADD COLUMN content_hash VARCHAR(64),
+    ADD COLUMN generation BIGINT;
+
+CREATE INDEX project_digest_generation_idx ON project_digest (generation);
@@ -0,0 +1 @@
+DROP TABLE embedding_cache;
\ No newline at end of file
@@ -0,0 +1,8 @@
+CREATE TABLE embedding_cache (
+    text_hash CHAR(64) NOT NULL,
+    model VARCHAR NOT NULL,
+    dims INTEGER NOT NULL,
+    embedding BYTEA NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (text_hash, model, dims)
+);
@@ -0,0 +1 @@
+ALTER TABLE project_digest DROP COLUMN text_hash;
\ No newline at end of file
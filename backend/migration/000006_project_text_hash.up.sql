@@ -0,0 +1 @@
+ALTER TABLE project_digest ADD COLUMN text_hash CHAR(64);
@@ -0,0 +1,3 @@
+DROP INDEX similarity_uuid_2_idx;
+
+ALTER TABLE project_digest DROP COLUMN neighbor_score;
\ No newline at end of file
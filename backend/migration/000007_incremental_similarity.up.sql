@@ -0,0 +1,3 @@
+ALTER TABLE project_digest ADD COLUMN neighbor_score REAL;
+
+CREATE INDEX similarity_uuid_2_idx ON similarity (uuid_2);
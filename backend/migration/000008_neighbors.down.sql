@@ -0,0 +1 @@
+DROP TABLE neighbors;
\ No newline at end of file
@@ -0,0 +1,5 @@
+CREATE TABLE neighbors (
+    project_uuid VARCHAR(255) PRIMARY KEY REFERENCES project(uuid) ON DELETE CASCADE,
+    neighbor_uuids VARCHAR(255)[] NOT NULL,
+    scores FLOAT[] NOT NULL
+);
@@ -0,0 +1 @@
+DROP SEQUENCE content_generation;
\ No newline at end of file
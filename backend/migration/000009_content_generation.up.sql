@@ -0,0 +1 @@
+CREATE SEQUENCE content_generation;
@@ -1,30 +1,48 @@
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
 from pydantic import BaseModel
-from typing import Optional, List
+from typing import Iterator, Optional, List
 import psycopg2
 import elasticsearch
 import asyncio
 
 from services.scheduler import update_projects
+from services._db_pool import ConnectionPool
+from services._loop_monitor import monitor
+from services._response_cache import cache_key, response_cache
+from services._vector_index import knn_search_async
 from openai import AsyncOpenAI
 
 router = APIRouter(prefix="")
 
 
-def get_db(request: Request) -> psycopg2.extensions.connection:
-    """Dependency to get database connection from app state"""
-    return request.app.state.db
+def get_db(request: Request) -> Iterator[psycopg2.extensions.connection]:
+    """Dependency to check out a database connection for one request"""
+    with request.app.state.db_pool.connection() as db:
+        yield db
+
+def get_db_pool(request: Request) -> ConnectionPool:
+    """Dependency for async handlers, which check out a connection only
+    around their database work instead of across awaits"""
+    return request.app.state.db_pool
 
 def get_es(request: Request) -> elasticsearch.Elasticsearch:
     """Dependency to get Elasticsearch client from app state"""
     return request.app.state.es
 
+def get_async_es(request: Request) -> elasticsearch.AsyncElasticsearch:
+    """Dependency to get the async Elasticsearch client for async handlers"""
+    return request.app.state.async_es
+
 def get_openai(request: Request) -> AsyncOpenAI:
     """Dependency to get OpenAI client from app state"""
     return request.app.state.openai_client
 
 @router.get("/types")
 def get_types(db: psycopg2.extensions.connection = Depends(get_db)):
+    return response_cache.get_or_compute(db, cache_key("types"),
+                                         lambda: _types(db))
+
+def _types(db: psycopg2.extensions.connection):
     cur = db.cursor()
     cur.execute("SELECT DISTINCT prize_type FROM prize")
     types = cur.fetchall()
@@ -47,15 +65,30 @@ class SearchQuery(BaseModel):
     page: Optional[int] = 1
     page_size: Optional[int] = 12
 
+def _pagination(q: SearchQuery) -> tuple[int, int]:
+    page = max(1, q.page or 1)
+    page_size = max(1, min(100, q.page_size or 12))  # Limit max page_size to 100
+    return page, page_size
+
 @router.post("/search")
 def search(q: SearchQuery,
            db: psycopg2.extensions.connection = Depends(get_db),
            es: elasticsearch.Elasticsearch = Depends(get_es)):
+    page, page_size = _pagination(q)
+    key = cache_key("search", event_name=q.event_name,
+                    prize_type=q.prize_type,
+                    sponsor_organization=q.sponsor_organization,
+                    query=q.query, page=page, page_size=page_size)
+    return response_cache.get_or_compute(db, key,
+                                         lambda: _search(q, db, es))
+
+def _search(q: SearchQuery,
+            db: psycopg2.extensions.connection,
+            es: elasticsearch.Elasticsearch):
     INDEX = "documents"
 
     # Pagination parameters
-    page = max(1, q.page or 1)
-    page_size = max(1, min(100, q.page_size or 12))  # Limit max page_size to 100
+    page, page_size = _pagination(q)
     from_offset = (page - 1) * page_size
 
     # Build Elasticsearch bool query with all filters
@@ -219,6 +252,18 @@ def graph(q: SearchQuery,
           threshold: float = 0.5,
           db: psycopg2.extensions.connection = Depends(get_db),
           es: elasticsearch.Elasticsearch = Depends(get_es)):
+    # the graph is not paginated, so pages share one entry
+    key = cache_key("graph", event_name=q.event_name,
+                    prize_type=q.prize_type,
+                    sponsor_organization=q.sponsor_organization,
+                    query=q.query, threshold=threshold)
+    return response_cache.get_or_compute(db, key,
+                                         lambda: _graph(q, threshold, db, es))
+
+def _graph(q: SearchQuery,
+           threshold: float,
+           db: psycopg2.extensions.connection,
+           es: elasticsearch.Elasticsearch):
     INDEX = "documents"
 
     # Build Elasticsearch bool query with all filters (same as /search)
@@ -349,21 +394,21 @@ def graph(q: SearchQuery,
 def similar(uuid: str,
             db: psycopg2.extensions.connection = Depends(get_db)):
     cur = db.cursor()
-    # Get top 20 most similar projects ordered by similarity score
+    # Get the precomputed list of most similar projects, ordered by score
     cur.execute(
-        "SELECT uuid_2, similarity_score FROM similarity WHERE uuid_1 = %s ORDER BY similarity_score DESC LIMIT 20",
+        "SELECT neighbor_uuids, scores FROM neighbors WHERE project_uuid = %s",
         (uuid,)
     )
-    results = cur.fetchall()
+    result = cur.fetchone()
     cur.close()
 
     # If no results, return empty list
-    if not results:
+    if not result:
         return []
 
     # Extract UUIDs and similarity scores
-    similar_uuids = [row[0] for row in results]
-    similarity_scores = {row[0]: row[1] for row in results}
+    similar_uuids, scores = result
+    similarity_scores = dict(zip(similar_uuids, scores))
 
     # Fetch full project data from database
     placeholders = ','.join(['%s'] * len(similar_uuids))
@@ -487,13 +532,23 @@ def get_project(uuid: str,
 
     return result
 
+async def embed_query(openai_client: AsyncOpenAI, text: str) -> list[float]:
+    """Embed a search query, answering 502 if the embedding provider fails"""
+    from services._fill_search import generate_embedding
+    try:
+        return await generate_embedding(openai_client, text)
+    except Exception as e:
+        print(f"Embedding the query failed: {e}")
+        raise HTTPException(status_code=502,
+                            detail="Embedding the query failed")
+
 class ChatQuery(BaseModel):
     query: str
 
 @router.post("/chat")
 async def chat(q: ChatQuery,
-               db: psycopg2.extensions.connection = Depends(get_db),
-               es: elasticsearch.Elasticsearch = Depends(get_es),
+               db_pool: ConnectionPool = Depends(get_db_pool),
+               es: elasticsearch.AsyncElasticsearch = Depends(get_async_es),
                openai_client: AsyncOpenAI = Depends(get_openai)):
     INDEX = "documents"
 
@@ -529,27 +584,17 @@ social media, messaging, social network, chat app, community platform, user prof
     search_query = chat_response.choices[0].message.content.strip()
     print(search_query)
     # Step 2: Generate embedding for the search query
-    from services._fill_search import generate_embedding
-    embedding = await generate_embedding(openai_client, search_query)
+    embedding = await embed_query(openai_client, search_query)
 
     # Step 3: Use KNN search to find similar projects (top 100)
-    res = es.search(
-        index=INDEX,
-        knn={
-            "field": "embedding",
-            "query_vector": embedding,
-            "k": 10,
-            "num_candidates": 50,
-        },
-        size=10,
-    )
+    hits = await knn_search_async(es, INDEX, embedding, k=10, num_candidates=50)
 
     # Extract results
     es_result_ids = []
     scores_map = {}
-    for hit in res["hits"]["hits"]:
-        es_result_ids.append(hit["_id"])
-        scores_map[hit["_id"]] = hit["_score"]
+    for uuid, score in hits:
+        es_result_ids.append(uuid)
+        scores_map[uuid] = score
 
     # If no results, return empty
     if not es_result_ids:
@@ -560,59 +605,65 @@ social media, messaging, social network, chat app, community platform, user prof
         }
 
     # Fetch full project data from database
-    placeholders = ','.join(['%s'] * len(es_result_ids))
-    cur = db.cursor()
-    cur.execute(
-        f"""
-        SELECT *
-        FROM project
-        WHERE uuid IN ({placeholders})
-        """, es_result_ids)
-    columns = [desc[0] for desc in cur.description]
-    projects = cur.fetchall()
-
-    # Fetch prizes for all matching projects
-    project_uuids = [project[0]
-                     for project in projects]  # uuid is first column
-    prizes_map = {}
-
-    if project_uuids:
-        prize_placeholders = ','.join(['%s'] * len(project_uuids))
-        cur.execute(
-            f"""
-            SELECT *
-            FROM prize
-            WHERE project_uuid IN ({prize_placeholders})
-        """, project_uuids)
-
-        prize_columns = [desc[0] for desc in cur.description]
-        for row in cur.fetchall():
-            project_uuid = row[0]
-            if project_uuid not in prizes_map:
-                prizes_map[project_uuid] = []
-            prize_dict = dict(zip(prize_columns, row))
-            prizes_map[project_uuid].append({
-                "project_uuid":
-                prize_dict["project_uuid"],
-                "name":
-                prize_dict["name"],
-                "pool_prize":
-                prize_dict["pool_prize"],
-                "prize_name":
-                prize_dict["prize_name"],
-                "prize_emoji":
-                prize_dict["prize_emoji"],
-                "prize_type":
-                prize_dict["prize_type"],
-                "sponsor_name":
-                prize_dict["sponsor_name"],
-                "sponsor_organization_name":
-                prize_dict["sponsor_organization_name"],
-                "sponsor_organization_square_logo_url":
-                prize_dict["sponsor_organization_square_logo_url"]
-            })
-
-    cur.close()
+    # sync DB reads in a background thread, off the event loop
+    def fetch_projects():
+        with db_pool.connection() as db:
+            placeholders = ','.join(['%s'] * len(es_result_ids))
+            cur = db.cursor()
+            cur.execute(
+                f"""
+                SELECT *
+                FROM project
+                WHERE uuid IN ({placeholders})
+                """, es_result_ids)
+            columns = [desc[0] for desc in cur.description]
+            projects = cur.fetchall()
+
+            # Fetch prizes for all matching projects
+            project_uuids = [project[0]
+                             for project in projects]  # uuid is first column
+            prizes_map = {}
+
+            if project_uuids:
+                prize_placeholders = ','.join(['%s'] * len(project_uuids))
+                cur.execute(
+                    f"""
+                    SELECT *
+                    FROM prize
+                    WHERE project_uuid IN ({prize_placeholders})
+                """, project_uuids)
+
+                prize_columns = [desc[0] for desc in cur.description]
+                for row in cur.fetchall():
+                    project_uuid = row[0]
+                    if project_uuid not in prizes_map:
+                        prizes_map[project_uuid] = []
+                    prize_dict = dict(zip(prize_columns, row))
+                    prizes_map[project_uuid].append({
+                        "project_uuid":
+                        prize_dict["project_uuid"],
+                        "name":
+                        prize_dict["name"],
+                        "pool_prize":
+                        prize_dict["pool_prize"],
+                        "prize_name":
+                        prize_dict["prize_name"],
+                        "prize_emoji":
+                        prize_dict["prize_emoji"],
+                        "prize_type":
+                        prize_dict["prize_type"],
+                        "sponsor_name":
+                        prize_dict["sponsor_name"],
+                        "sponsor_organization_name":
+                        prize_dict["sponsor_organization_name"],
+                        "sponsor_organization_square_logo_url":
+                        prize_dict["sponsor_organization_square_logo_url"]
+                    })
+
+            cur.close()
+            return columns, projects, prizes_map
+
+    columns, projects, prizes_map = await asyncio.to_thread(fetch_projects)
 
     # Build response with full entries and similarity scores
     response = []
@@ -683,83 +734,80 @@ class EmbeddingsQuery(BaseModel):
 
 @router.post("/embeddings")
 async def embeddings(q: EmbeddingsQuery,
-                     db: psycopg2.extensions.connection = Depends(get_db),
-                     es: elasticsearch.Elasticsearch = Depends(get_es),
+                     db_pool: ConnectionPool = Depends(get_db_pool),
+                     es: elasticsearch.AsyncElasticsearch = Depends(get_async_es),
                      openai_client: AsyncOpenAI = Depends(get_openai)):
     INDEX = "documents"
 
     # Step 1: Generate embedding for the user-provided keywords (no LLM chat step)
-    from services._fill_search import generate_embedding
-    embedding = await generate_embedding(openai_client, q.keywords)
+    embedding = await embed_query(openai_client, q.keywords)
 
     # Step 2: Use KNN search to find similar projects (top 100)
-    res = es.search(
-        index=INDEX,
-        knn={
-            "field": "embedding",
-            "query_vector": embedding,
-            "k": 100,
-            "num_candidates": 500,
-        },
-        size=100,
-    )
+    hits = await knn_search_async(es, INDEX, embedding, k=100,
+                                  num_candidates=500)
 
     # Extract results
     es_result_ids = []
     scores_map = {}
-    for hit in res["hits"]["hits"]:
-        es_result_ids.append(hit["_id"])
-        scores_map[hit["_id"]] = hit["_score"]
+    for uuid, score in hits:
+        es_result_ids.append(uuid)
+        scores_map[uuid] = score
 
     # If no results, return empty
     if not es_result_ids:
         return []
 
     # Fetch full project data from database
-    placeholders = ','.join(['%s'] * len(es_result_ids))
-    cur = db.cursor()
-    cur.execute(
-        f"""
-        SELECT *
-        FROM project
-        WHERE uuid IN ({placeholders})
-        """, es_result_ids)
-    columns = [desc[0] for desc in cur.description]
-    projects = cur.fetchall()
-
-    # Fetch prizes for all matching projects
-    project_uuids = [project[0]
-                     for project in projects]  # uuid is first column
-    prizes_map = {}
-
-    if project_uuids:
-        prize_placeholders = ','.join(['%s'] * len(project_uuids))
-        cur.execute(
-            f"""
-            SELECT *
-            FROM prize
-            WHERE project_uuid IN ({prize_placeholders})
-        """, project_uuids)
-
-        prize_columns = [desc[0] for desc in cur.description]
-        for row in cur.fetchall():
-            project_uuid = row[0]
-            if project_uuid not in prizes_map:
-                prizes_map[project_uuid] = []
-            prize_dict = dict(zip(prize_columns, row))
-            prizes_map[project_uuid].append({
-                "project_uuid": prize_dict["project_uuid"],
-                "name": prize_dict["name"],
-                "pool_prize": prize_dict["pool_prize"],
-                "prize_name": prize_dict["prize_name"],
-                "prize_emoji": prize_dict["prize_emoji"],
-                "prize_type": prize_dict["prize_type"],
-                "sponsor_name": prize_dict["sponsor_name"],
-                "sponsor_organization_name": prize_dict["sponsor_organization_name"],
-                "sponsor_organization_square_logo_url": prize_dict["sponsor_organization_square_logo_url"]
-            })
-
-    cur.close()
+    # sync DB reads in a background thread, off the event loop
+    def fetch_projects():
+        with db_pool.connection() as db:
+            placeholders = ','.join(['%s'] * len(es_result_ids))
+            cur = db.cursor()
+            cur.execute(
+                f"""
+                SELECT *
+                FROM project
+                WHERE uuid IN ({placeholders})
+                """, es_result_ids)
+            columns = [desc[0] for desc in cur.description]
+            projects = cur.fetchall()
+
+            # Fetch prizes for all matching projects
+            project_uuids = [project[0]
+                             for project in projects]  # uuid is first column
+            prizes_map = {}
+
+            if project_uuids:
+                prize_placeholders = ','.join(['%s'] * len(project_uuids))
+                cur.execute(
+                    f"""
+                    SELECT *
+                    FROM prize
+                    WHERE project_uuid IN ({prize_placeholders})
+                """, project_uuids)
+
+                prize_columns = [desc[0] for desc in cur.description]
+                for row in cur.fetchall():
+                    project_uuid = row[0]
+                    if project_uuid not in prizes_map:
+                        prizes_map[project_uuid] = []
+                    prize_dict = dict(zip(prize_columns, row))
+                    prizes_map[project_uuid].append({
+                        "project_uuid": prize_dict["project_uuid"],
+                        "name": prize_dict["name"],
+                        "pool_prize": prize_dict["pool_prize"],
+                        "prize_name": prize_dict["prize_name"],
+                        "prize_emoji": prize_dict["prize_emoji"],
+                        "prize_type": prize_dict["prize_type"],
+                        "sponsor_name": prize_dict["sponsor_name"],
+                        "sponsor_organization_name": prize_dict["sponsor_organization_name"],
+                        "sponsor_organization_square_logo_url": prize_dict["sponsor_organization_square_logo_url"]
+                    })
+
+            cur.close()
+            return columns, projects, prizes_map
+
+    columns, projects, prizes_map = await asyncio.to_thread(fetch_projects)
 
     # Build response with full entries and similarity scores
     response = []
@@ -779,3 +827,10 @@ async def embeddings(q: EmbeddingsQuery,
     response.sort(key=lambda x: x.get("similarity_score", 0),reverse=True)
 
     return response
+
+
+@router.get("/metrics")
+def metrics():
+    """Event-loop lag and response cache hit rates"""
+    return {"event_loop": monitor.stats(),
+            "response_cache": response_cache.stats()}
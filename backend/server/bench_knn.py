@@ -0,0 +1,86 @@
+"""Compare in-process kNN over the embedding snapshot with Elasticsearch kNN.
+
+Queries are vectors sampled from the snapshot. The exact local search is
+the reference for recall; both paths report latency.
+
+    uv run bench_knn.py --k 100 --num-candidates 500
+    uv run bench_knn.py --local-only   # no Elasticsearch needed
+"""
+import argparse
+import random
+import statistics
+import time
+
+import elasticsearch
+
+from services._config import ES_URL
+from services._fill_search import INDEX
+from services._snapshot import load_snapshot
+from services._vector_index import es_search, local_search
+
+
+def timed(search, queries) -> tuple[list[list[str]], list[float]]:
+    results = []
+    latencies = []
+    for query in queries:
+        started = time.perf_counter()
+        hits = search(query)
+        latencies.append((time.perf_counter() - started) * 1000)
+        results.append([uuid for uuid, _ in hits])
+    return results, sorted(latencies)
+
+
+def report(name: str, latencies: list[float], recall: float | None = None):
+    line = (f"{name:6} p50 {statistics.median(latencies):7.2f} ms  "
+            f"p95 {latencies[int(len(latencies) * 0.95)]:7.2f} ms")
+    if recall is not None:
+        line += f"  recall {recall:.3f}"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--num-candidates", type=int, default=50)
+    parser.add_argument("--local-only", action="store_true")
+    args = parser.parse_args()
+
+    snapshot = load_snapshot()
+    if snapshot is None or len(snapshot) == 0:
+        print("No embedding snapshot, run an ingest first")
+        return
+    rows = random.Random(0).sample(range(len(snapshot)),
+                                   min(args.queries, len(snapshot)))
+    queries = [snapshot.matrix[row].tolist() for row in rows]
+    print(f"Snapshot {snapshot.generation}: {len(snapshot)} vectors of "
+          f"{snapshot.matrix.shape[1]} dims, {len(queries)} queries, "
+          f"k={args.k}", flush=True)
+
+    # warm the page cache before timing
+    snapshot.matrix.sum()
+    exact, latencies = timed(lambda q: local_search(snapshot, q, args.k),
+                             queries)
+    report("local", latencies, 1.0)
+    if args.local_only:
+        return
+
+    es = elasticsearch.Elasticsearch(
+        ES_URL,
+        verify_certs=False,
+        ssl_show_warn=False,
+    )
+    try:
+        search = lambda q: es_search(es, INDEX, q, args.k, args.num_candidates)
+        timed(search, queries[:10])
+        approximate, latencies = timed(search, queries)
+        recall = statistics.mean(
+            len(set(a) & set(e)) / len(e)
+            for a, e in zip(approximate, exact) if e)
+        report("es", latencies, recall)
+    finally:
+        es.close()
+
+
+if __name__ == "__main__":
+    main()
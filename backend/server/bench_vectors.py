@@ -0,0 +1,144 @@
+"""Compare the full and compact vector layouts of the documents index.
+
+Builds a throwaway index per layout from the embedding cache and reports
+its store size, kNN latency and recall against an exact cosine search.
+
+    ES_VECTOR_INDEX_TYPE=bbq_hnsw uv run bench_vectors.py --queries 100
+"""
+import argparse
+import random
+import statistics
+import time
+
+import elasticsearch
+import psycopg2
+
+from services._config import DB_URL, ES_URL
+from services._embedding_cache import load_project_embeddings
+from services._embeddings import DIMS, MODEL
+from services._fill_search import (BULK_LOAD_SETTINGS, VECTOR_INDEX_TYPE,
+                                   build_mapping, finish_bulk_load,
+                                   index_documents)
+
+MODES = ["full", "compact"]
+
+
+def build_index(es: elasticsearch.Elasticsearch, index: str, mode: str,
+                embeddings: dict[str, list[float]]):
+    es.indices.delete(index=index, ignore_unavailable=True)
+    es.indices.create(index=index, body={**build_mapping(mode, DIMS),
+                                         "settings": BULK_LOAD_SETTINGS})
+    docs = {}
+    for uuid, embedding in embeddings.items():
+        docs[uuid] = {"embedding": embedding}
+        if mode != "compact":
+            docs[uuid]["raw_embedding"] = embedding
+    index_documents(es, index, docs)
+    finish_bulk_load(es, index)
+    # merge segments so sizes aren't skewed by pending merges
+    es.indices.forcemerge(index=index, max_num_segments=1)
+    stats = es.indices.stats(index=index, metric="store")
+    return stats["indices"][index]["primaries"]["store"]["size_in_bytes"]
+
+
+def exact_search(es: elasticsearch.Elasticsearch, index: str,
+                 embedding: list[float], k: int) -> list[str]:
+    res = es.search(index=index,
+                    query={
+                        "script_score": {
+                            "query": {"match_all": {}},
+                            "script": {
+                                "source": "cosineSimilarity(params.q, 'embedding') + 1.0",
+                                "params": {"q": embedding}
+                            }
+                        }
+                    },
+                    size=k,
+                    source=False)
+    return [hit["_id"] for hit in res["hits"]["hits"]]
+
+
+def knn_search(es: elasticsearch.Elasticsearch, index: str,
+               embedding: list[float], k: int,
+               num_candidates: int) -> tuple[list[str], float]:
+    started = time.perf_counter()
+    res = es.search(index=index,
+                    knn={
+                        "field": "embedding",
+                        "query_vector": embedding,
+                        "k": k,
+                        "num_candidates": num_candidates,
+                    },
+                    size=k,
+                    source=False)
+    elapsed = time.perf_counter() - started
+    return [hit["_id"] for hit in res["hits"]["hits"]], elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=30)
+    parser.add_argument("--num-candidates", type=int, default=100)
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the benchmark indices afterwards")
+    args = parser.parse_args()
+
+    db = psycopg2.connect(DB_URL)
+    es = elasticsearch.Elasticsearch(
+        ES_URL,
+        verify_certs=False,
+        ssl_show_warn=False,
+        request_timeout=600,
+    )
+    try:
+        embeddings = load_project_embeddings(db, MODEL, DIMS)
+        if not embeddings:
+            print("No embeddings in the cache, run an ingest first")
+            return
+        queries = random.Random(0).sample(list(embeddings),
+                                          min(args.queries, len(embeddings)))
+        print(f"{len(embeddings)} vectors of {DIMS} dims, "
+              f"{len(queries)} queries, k={args.k}, "
+              f"compact type {VECTOR_INDEX_TYPE}", flush=True)
+
+        indices = {mode: f"bench_vectors_{mode}" for mode in MODES}
+        sizes = {
+            mode: build_index(es, index, mode, embeddings)
+            for mode, index in indices.items()
+        }
+
+        # exact ranking on the unquantized vectors is the reference
+        truth = {
+            uuid: set(exact_search(es, indices["full"], embeddings[uuid], args.k))
+            for uuid in queries
+        }
+
+        for mode, index in indices.items():
+            # warm up caches before timing
+            for uuid in queries[:5]:
+                knn_search(es, index, embeddings[uuid], args.k,
+                           args.num_candidates)
+            latencies = []
+            recalls = []
+            for uuid in queries:
+                hits, elapsed = knn_search(es, index, embeddings[uuid], args.k,
+                                           args.num_candidates)
+                latencies.append(elapsed * 1000)
+                recalls.append(len(truth[uuid] & set(hits)) / len(truth[uuid]))
+            latencies.sort()
+            print(f"{mode:8} size {sizes[mode] / 2**20:9.1f} MiB  "
+                  f"p50 {statistics.median(latencies):6.1f} ms  "
+                  f"p95 {latencies[int(len(latencies) * 0.95)]:6.1f} ms  "
+                  f"recall@{args.k} {statistics.mean(recalls):.3f}")
+
+        if not args.keep:
+            for index in indices.values():
+                es.indices.delete(index=index, ignore_unavailable=True)
+    finally:
+        db.close()
+        es.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""Run one ingest outside the API server.
+
+    GRAPHQL_CACHE=record uv run ingest.py   # crawl and record responses
+    GRAPHQL_CACHE=replay uv run ingest.py   # re-ingest from the recording
+    uv run ingest.py --rebuild              # also rebuild the search index
+"""
+import asyncio
+import os
+import sys
+
+import elasticsearch
+import psycopg2
+from openai import AsyncOpenAI
+
+from services._config import DB_URL, ES_URL
+from services.scheduler import update_projects
+
+
+async def main():
+    db = psycopg2.connect(DB_URL)
+    es = elasticsearch.Elasticsearch(
+        ES_URL,
+        verify_certs=False,
+        ssl_show_warn=False,
+    )
+    openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    try:
+        await update_projects(db, es, openai_client,
+                              force="--force" in sys.argv,
+                              rebuild="--rebuild" in sys.argv)
+    finally:
+        db.close()
+        es.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
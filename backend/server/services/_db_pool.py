@@ -0,0 +1,69 @@
+import contextlib
+import os
+import threading
+
+import psycopg2
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+# Connections kept open and the most handed out at once, per pool
+READ_POOL_MIN = int(os.getenv("DB_READ_POOL_MIN", "1"))
+READ_POOL_MAX = int(os.getenv("DB_READ_POOL_MAX", "10"))
+INGEST_POOL_MIN = int(os.getenv("DB_INGEST_POOL_MIN", "1"))
+INGEST_POOL_MAX = int(os.getenv("DB_INGEST_POOL_MAX", "2"))
+# Seconds to wait for a free connection before giving up
+CHECKOUT_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+
+class ConnectionPool:
+    """A thread-safe pool that waits for a free connection when exhausted.
+
+    psycopg2's ThreadedConnectionPool raises as soon as every connection
+    is taken; callers here queue for one instead.
+    """
+
+    def __init__(self, dsn: str, minconn: int, maxconn: int,
+                 readonly: bool = False):
+        self.readonly = readonly
+        self._pool = ThreadedConnectionPool(minconn, maxconn, dsn)
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def acquire(self) -> psycopg2.extensions.connection:
+        if not self._slots.acquire(timeout=CHECKOUT_TIMEOUT):
+            raise PoolError(
+                f"no connection free after {CHECKOUT_TIMEOUT}s")
+        try:
+            conn = self._pool.getconn()
+            if self.readonly and not conn.autocommit:
+                # reads never hold a transaction open between queries
+                conn.set_session(readonly=True, autocommit=True)
+        except BaseException:
+            self._slots.release()
+            raise
+        return conn
+
+    def release(self, conn: psycopg2.extensions.connection):
+        """Return a connection, discarding it if it broke."""
+        try:
+            if not conn.closed and not conn.autocommit:
+                conn.rollback()
+        except psycopg2.Error:
+            pass
+        self._pool.putconn(conn, close=bool(conn.closed))
+        self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        self._pool.closeall()
+
+
+def open_pools(dsn: str) -> tuple[ConnectionPool, ConnectionPool]:
+    """Create the API's read pool and the ingest jobs' write pool."""
+    return (ConnectionPool(dsn, READ_POOL_MIN, READ_POOL_MAX, readonly=True),
+            ConnectionPool(dsn, INGEST_POOL_MIN, INGEST_POOL_MAX))
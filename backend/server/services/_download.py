@@ -1,107 +1,285 @@
+import asyncio
+import contextlib
+import dataclasses
+import datetime
+import email.utils
+import json
+import os
+import random
+from typing import AsyncIterator, Iterable
+
 import httpx
 
+from ._graphql_cache import ResponseCache
+
+GRAPHQL_ENDPOINT = os.getenv("GRAPHQL_ENDPOINT",
+                             "https://api.ethglobal.com/graphql")
+
 GRAPHQL_URL = open("services/download.gql", "r").read()
 GRAPHQL_URL_LINKS = open("services/download_links.gql", "r").read()
 GRAPHQL_URL_EVENTS = open("services/download_hackathons.gql", "r").read()
 
 AMOUNT = 500
+# Maximum number of requests in flight against the GraphQL API
+CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "8"))
+# Maximum number of hackathons downloaded at the same time
+EVENT_CONCURRENCY = int(os.getenv("DOWNLOAD_EVENT_CONCURRENCY", "4"))
+
+# Attempts per request before the request is given up
+MAX_ATTEMPTS = int(os.getenv("DOWNLOAD_MAX_ATTEMPTS", "6"))
+# Backoff before retry n is drawn from [0, min(MAX_DELAY, BASE_DELAY * 2^n)]
+BASE_DELAY = float(os.getenv("DOWNLOAD_BASE_DELAY", "1"))
+MAX_DELAY = float(os.getenv("DOWNLOAD_MAX_DELAY", "60"))
+# Consecutive failed attempts after which the rest of the run fails fast
+BREAKER_THRESHOLD = int(os.getenv("DOWNLOAD_BREAKER_THRESHOLD", "20"))
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    """A request failed for good."""
+
+
+class CircuitOpenError(DownloadError):
+    """Too many consecutive failures in this run, upstream looks down."""
+
+
+class CircuitBreaker:
+    """Stops a run from hammering the API once it keeps failing.
+
+    The breaker opens after `threshold` failed attempts in a row and stays
+    open for the rest of the run; any success closes the streak.
+    """
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD):
+        self.threshold = threshold
+        self.failures = 0
 
-async def download_hackathons() -> list[dict]:
-    async with httpx.AsyncClient(timeout=60) as client:
-        res = await client.post("https://api.ethglobal.com/graphql",
-                                json={
-                                    "operationName": "getPublishedHackathons",
-                                    "query": GRAPHQL_URL_EVENTS
-                                })
+    @property
+    def open(self) -> bool:
+        return self.failures >= self.threshold
+
+    def check(self):
+        if self.open:
+            raise CircuitOpenError(
+                f"Circuit open after {self.failures} consecutive failures")
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+
+
+@dataclasses.dataclass
+class DownloadSession:
+    """State shared by every request of one download run."""
+    client: httpx.AsyncClient
+    endpoint: str = GRAPHQL_ENDPOINT
+    breaker: CircuitBreaker = dataclasses.field(default_factory=CircuitBreaker)
+    cache: ResponseCache | None = None
+    # event slug -> error that made its download fail
+    failures: dict[str, DownloadError] = dataclasses.field(default_factory=dict)
+
+
+@contextlib.asynccontextmanager
+async def open_session(
+        endpoint: str = GRAPHQL_ENDPOINT,
+        concurrency: int = CONCURRENCY,
+        cache: ResponseCache | None = None) -> AsyncIterator[DownloadSession]:
+    """Open the pooled client shared by every request of a download run.
+
+    The connection limit is the concurrency limit: requests beyond it wait
+    for a free keep-alive connection instead of opening a new one. Without
+    an explicit cache, the one configured by GRAPHQL_CACHE is used.
+    """
+    async with httpx.AsyncClient(
+            timeout=httpx.Timeout(60, pool=None),
+            limits=httpx.Limits(
+                max_connections=concurrency,
+                max_keepalive_connections=concurrency)) as client:
+        yield DownloadSession(client=client,
+                              endpoint=endpoint,
+                              cache=cache or ResponseCache.from_env())
+
+
+def _retry_delay(attempt: int, res: httpx.Response | None) -> float:
+    """Seconds to wait before the next attempt, at most MAX_DELAY."""
+    retry_after = res.headers.get("Retry-After") if res is not None else None
+    if retry_after:
         try:
-            return res.json()["data"]["getPublishedHackathons"]
-        except:
-            print("Status code:", res.status_code)
-            print("Response body:", res.text)
-            raise Exception("Error downloading hackathons")
-
-async def download_projects(event) -> list[dict]:
-    all = []
-    skip = 0
-    while True:
+            return min(MAX_DELAY, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
         try:
-            async with httpx.AsyncClient(timeout=60) as client:
-                data = {
-                    "operationName": "GetPaginatedSubmittedProjects",
-                    "variables": {
-                        "pagination": {
-                            "skip": skip,
-                            "take": AMOUNT
-                        },
-                        "filters": {
-                            "events": [event]
-                        }
-                    },
-                    "query": GRAPHQL_URL
-                }
-                res = await client.post("https://api.ethglobal.com/graphql",
-                                        json=data)
-                try:
-                    if len(res.json()["data"]["getPaginatedSubmittedProjects"]
-                           ["items"]) < AMOUNT:
-                        pass
-                except:
-                    print("Status code:", res.status_code)
-                    print("Response body:", res.text)
-                    raise Exception("Error downloading projects")
-
-        except:
-            continue
-
-        skip += AMOUNT
-        all.extend(
-            res.json()["data"]["getPaginatedSubmittedProjects"]["items"])
-        if len(res.json()["data"]["getPaginatedSubmittedProjects"]
-                           ["items"]) < AMOUNT:
-            break
-
-    return all
-
-
-async def download_links() -> list[dict]:
-    all = []
-    skip = 0
-    while True:
-        print(skip)
+            until = email.utils.parsedate_to_datetime(retry_after)
+            now = datetime.datetime.now(datetime.timezone.utc)
+            return min(MAX_DELAY, max(0.0, (until - now).total_seconds()))
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2**attempt))
+
+
+async def _graphql(session: DownloadSession, data: dict, field: str):
+    """POST a GraphQL operation and return `data[field]` of the response.
+
+    Transport errors, malformed responses and the statuses in RETRY_STATUS
+    are retried with jittered exponential backoff, honouring Retry-After.
+    Successful responses are recorded in, and served from, the session's
+    response cache.
+    """
+    description = f"{data['operationName']} {data.get('variables', {})}"
+    if session.cache is not None:
+        body = await asyncio.to_thread(session.cache.get, data)
+        if body is not None:
+            return json.loads(body)["data"][field]
+        if session.cache.replay:
+            raise DownloadError(f"{description} is not in the replay cache")
+
+    error = None
+    for attempt in range(MAX_ATTEMPTS):
+        session.breaker.check()
+        res = None
+        try:
+            res = await session.client.post(session.endpoint, json=data)
+            if res.status_code == 200:
+                result = res.json()["data"][field]
+                session.breaker.record_success()
+                if session.cache is not None and result is not None:
+                    await asyncio.to_thread(session.cache.put, data,
+                                            res.content)
+                return result
+            error = f"status {res.status_code}: {res.text[:200]}"
+            if res.status_code not in RETRY_STATUS:
+                raise DownloadError(f"{description} failed with {error}")
+        except (httpx.TransportError, ValueError, KeyError, TypeError) as e:
+            error = repr(e)
+
+        session.breaker.record_failure()
+        if attempt + 1 < MAX_ATTEMPTS:
+            delay = _retry_delay(attempt, res)
+            print(f"{description} failed ({error}), "
+                  f"retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    raise DownloadError(
+        f"{description} failed after {MAX_ATTEMPTS} attempts: {error}")
+
+
+async def download_hackathons(session: DownloadSession) -> list[dict]:
+    return await _graphql(session, {
+        "operationName": "getPublishedHackathons",
+        "query": GRAPHQL_URL_EVENTS
+    }, "getPublishedHackathons")
+
+
+async def _fetch_page(session: DownloadSession, query: str, filters: dict,
+                      skip: int) -> dict:
+    """Fetch a single page of submitted projects."""
+    return await _graphql(session, {
+        "operationName": "GetPaginatedSubmittedProjects",
+        "variables": {
+            "pagination": {
+                "skip": skip,
+                "take": AMOUNT
+            },
+            "filters": filters
+        },
+        "query": query
+    }, "getPaginatedSubmittedProjects")
+
+
+async def _iter_pages(session: DownloadSession, query: str,
+                      filters: dict) -> AsyncIterator[list[dict]]:
+    """Yield the items of every page of a query as the pages arrive.
+
+    The first page reports the total, so the remaining pages are requested
+    in parallel, with at most CONCURRENCY of them in flight (and therefore
+    in memory) at once. Without a total, pages are followed one by one
+    until a short page comes back.
+    """
+    first = await _fetch_page(session, query, filters, 0)
+    yield first["items"]
+    if len(first["items"]) < AMOUNT:
+        return
+
+    total = first.get("total")
+    if total is None:
+        skip = AMOUNT
+        while True:
+            page = await _fetch_page(session, query, filters, skip)
+            yield page["items"]
+            if len(page["items"]) < AMOUNT:
+                return
+            skip += AMOUNT
+
+    skips = iter(range(AMOUNT, total, AMOUNT))
+    pending = set()
+    try:
+        while True:
+            for skip in skips:
+                pending.add(
+                    asyncio.create_task(
+                        _fetch_page(session, query, filters, skip)))
+                if len(pending) >= CONCURRENCY:
+                    break
+            if not pending:
+                return
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()["items"]
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+def download_projects(session: DownloadSession,
+                      event) -> AsyncIterator[list[dict]]:
+    return _iter_pages(session, GRAPHQL_URL, {"events": [event]})
+
+
+async def download_events(
+        session: DownloadSession,
+        events: Iterable[str]) -> AsyncIterator[tuple[str, list[dict]]]:
+    """Download several hackathons concurrently.
+
+    Yields (event, page) as pages arrive from any of the hackathons. The
+    hand-off queue is small, so downloads pause while the caller is busy
+    storing instead of piling pages up in memory. A hackathon that fails
+    for good is recorded in `session.failures` and the others carry on;
+    pages it yielded before failing may be incomplete.
+    """
+    sem = asyncio.Semaphore(EVENT_CONCURRENCY)
+    queue = asyncio.Queue(maxsize=EVENT_CONCURRENCY)
+    done = object()
+
+    async def download_one(event):
+        async with sem:
+            try:
+                async for page in download_projects(session, event):
+                    await queue.put((event, page))
+            except DownloadError as e:
+                print(f"Failed to download hackathon {event}: {e}")
+                session.failures[event] = e
+
+    async def download_all():
         try:
-            async with httpx.AsyncClient(timeout=60) as client:
-                data = {
-                    "operationName": "GetPaginatedSubmittedProjects",
-                    "variables": {
-                        "pagination": {
-                            "skip": skip,
-                            "take": AMOUNT
-                        },
-                        "filters": {
-                            # "events": [event]
-                        }
-                    },
-                    "query": GRAPHQL_URL_LINKS
-                }
-                res = await client.post("https://api.ethglobal.com/graphql",
-                                        json=data)
-                try:
-                    if len(res.json()["data"]["getPaginatedSubmittedProjects"]
-                           ["items"]) < AMOUNT:
-                        pass
-                except:
-                    print("Status code:", res.status_code)
-                    print("Response body:", res.text)
-                    raise Exception("Error downloading projects")
-
-        except:
-            continue
-
-        skip += AMOUNT
-        all.extend(
-            res.json()["data"]["getPaginatedSubmittedProjects"]["items"])
-        if len(res.json()["data"]["getPaginatedSubmittedProjects"]
-               ["items"]) < AMOUNT:
-            break
-
-    return all
+            await asyncio.gather(*(download_one(event) for event in events))
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(done)
+
+    task = asyncio.create_task(download_all())
+    try:
+        while (item := await queue.get()) is not done:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()
+
+
+def download_links(session: DownloadSession) -> AsyncIterator[list[dict]]:
+    return _iter_pages(session, GRAPHQL_URL_LINKS, {})
@@ -0,0 +1,117 @@
+import array
+import hashlib
+import sys
+import unicodedata
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def text_hash(text: str) -> str:
+    """Key of the text an embedding is generated from."""
+    return hashlib.sha256(normalize_text(text).encode()).hexdigest()
+
+
+def _to_bytes(embedding: list[float]) -> bytes:
+    """Pack a vector as little-endian float32."""
+    values = array.array("f", embedding)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(data: bytes) -> list[float]:
+    values = array.array("f")
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tolist()
+
+
+def get_cached_embeddings(db_connection: psycopg2.extensions.connection,
+                          hashes: list[str], model: str,
+                          dims: int) -> dict[str, list[float]]:
+    """Return the cached embeddings of the given text hashes."""
+    if not hashes:
+        return {}
+    with db_connection.cursor() as cur:
+        cur.execute("""
+            SELECT text_hash, embedding
+            FROM embedding_cache
+            WHERE model = %s AND dims = %s AND text_hash = ANY(%s)
+              AND octet_length(embedding) = %s
+        """, (model, dims, list(hashes), dims * 4))
+        return {row[0]: _from_bytes(bytes(row[1])) for row in cur.fetchall()}
+
+
+def put_cached_embeddings(db_connection: psycopg2.extensions.connection,
+                          embeddings: dict[str, list[float]], model: str,
+                          dims: int) -> int:
+    """Store embeddings by text hash; existing entries are kept.
+
+    Vectors that are not `dims` wide are skipped, so they are never served
+    back under this key, and an existing entry of the wrong width is
+    replaced.
+    """
+    wrong = [key for key, embedding in embeddings.items()
+             if len(embedding) != dims]
+    if wrong:
+        print(f"Not caching {len(wrong)} embeddings that are not {dims} wide")
+        embeddings = {key: embedding for key, embedding in embeddings.items()
+                      if len(embedding) == dims}
+    if not embeddings:
+        return 0
+    with db_connection.cursor() as cur:
+        execute_values(cur, f"""
+            INSERT INTO embedding_cache (text_hash, model, dims, embedding)
+            VALUES %s
+            ON CONFLICT (text_hash, model, dims) DO UPDATE
+                SET embedding = EXCLUDED.embedding
+                WHERE octet_length(embedding_cache.embedding) <> {int(dims) * 4}
+        """, [(text_hash, model, dims, psycopg2.Binary(_to_bytes(embedding)))
+              for text_hash, embedding in embeddings.items()],
+                       page_size=500)
+    db_connection.commit()
+    return len(embeddings)
+
+
+def record_text_hashes(db_connection: psycopg2.extensions.connection,
+                       hashes: dict[str, str]) -> int:
+    """Link projects to the cached embedding of the text they were indexed with."""
+    if not hashes:
+        return 0
+    with db_connection.cursor() as cur:
+        execute_values(cur, """
+            UPDATE project_digest d SET text_hash = v.text_hash
+            FROM (VALUES %s) AS v (project_uuid, text_hash)
+            WHERE d.project_uuid = v.project_uuid
+        """, list(hashes.items()), page_size=1000)
+    db_connection.commit()
+    return len(hashes)
+
+
+def load_project_embeddings(db_connection: psycopg2.extensions.connection,
+                            model: str,
+                            dims: int,
+                            uuids: list[str] | None = None
+                            ) -> dict[str, list[float]]:
+    """Return the indexed embedding of every project, or only of `uuids`.
+
+    This is the side store vector consumers read from, so they never need
+    vectors in the search index's _source.
+    """
+    with db_connection.cursor() as cur:
+        cur.execute("""
+            SELECT d.project_uuid, c.embedding
+            FROM project_digest d
+            JOIN embedding_cache c
+              ON c.text_hash = d.text_hash AND c.model = %(model)s AND c.dims = %(dims)s
+             AND octet_length(c.embedding) = %(dims)s * 4
+            WHERE %(all)s OR d.project_uuid = ANY(%(uuids)s)
+        """, {"model": model, "dims": dims, "all": uuids is None,
+              "uuids": list(uuids or [])})
+        return {row[0]: _from_bytes(bytes(row[1])) for row in cur.fetchall()}
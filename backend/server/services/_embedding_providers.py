@@ -0,0 +1,177 @@
+import asyncio
+import hashlib
+import math
+import os
+import random
+import re
+import threading
+
+import openai
+from openai import AsyncOpenAI
+
+# Attempts per request on rate limits and transient errors
+MAX_ATTEMPTS = int(os.getenv("EMBEDDING_MAX_ATTEMPTS", "6"))
+# Longest wait before a retry, whether backed off or asked for by Retry-After
+MAX_DELAY = float(os.getenv("EMBEDDING_MAX_DELAY", "60"))
+
+# Directory with model.onnx and tokenizer.json of a sentence embedding model
+LOCAL_MODEL_DIR = os.getenv("EMBEDDING_LOCAL_MODEL", "models/all-MiniLM-L6-v2")
+# Texts per inference call and the tokens each is truncated to
+LOCAL_BATCH_SIZE = int(os.getenv("EMBEDDING_LOCAL_BATCH_SIZE", "32"))
+LOCAL_MAX_LENGTH = int(os.getenv("EMBEDDING_LOCAL_MAX_LENGTH", "512"))
+# Threads ONNX Runtime uses within one inference call, 0 for all cores
+LOCAL_THREADS = int(os.getenv("EMBEDDING_LOCAL_THREADS", "0"))
+
+
+def _retry_delay(attempt: int, error: openai.OpenAIError) -> float:
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return min(MAX_DELAY,
+                       max(0.0, float(response.headers.get("retry-after"))))
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(MAX_DELAY, 2**attempt))
+
+
+class OpenAIProvider:
+    """Embeddings from the OpenAI API."""
+
+    def __init__(self, model: str, dims: int):
+        self.model = model
+        self.dims = dims
+
+    async def embed(self, openai_client: AsyncOpenAI,
+                    texts: list[str]) -> list[list[float]]:
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                response = await openai_client.embeddings.create(
+                    model=self.model, input=texts, dimensions=self.dims)
+                return [
+                    data.embedding
+                    for data in sorted(response.data, key=lambda d: d.index)
+                ]
+            except (openai.RateLimitError, openai.APIConnectionError,
+                    openai.InternalServerError) as e:
+                if attempt + 1 == MAX_ATTEMPTS:
+                    raise
+                delay = _retry_delay(attempt, e)
+                print(f"Embedding request failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+
+class LocalProvider:
+    """Embeddings from a sentence embedding model run with ONNX Runtime on CPU.
+
+    Token states are mean-pooled over the attention mask and normalized.
+    Needs the `local` extra (numpy, onnxruntime, tokenizers).
+    """
+
+    def __init__(self, model_dir: str, dims: int):
+        self.model = f"local:{os.path.basename(os.path.normpath(model_dir))}"
+        self.model_dir = model_dir
+        self.dims = dims
+        self._session = None
+        self._tokenizer = None
+        # one inference at a time; each already uses LOCAL_THREADS cores
+        self._lock = threading.Lock()
+
+    def _load(self):
+        import onnxruntime
+        import tokenizers
+
+        tokenizer = tokenizers.Tokenizer.from_file(
+            os.path.join(self.model_dir, "tokenizer.json"))
+        tokenizer.enable_truncation(max_length=LOCAL_MAX_LENGTH)
+        tokenizer.enable_padding()
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = LOCAL_THREADS
+        self._session = onnxruntime.InferenceSession(
+            os.path.join(self.model_dir, "model.onnx"),
+            options,
+            providers=["CPUExecutionProvider"])
+        self._tokenizer = tokenizer
+
+    def _embed_sync(self, texts: list[str]) -> list[list[float]]:
+        import numpy as np
+
+        with self._lock:
+            if self._session is None:
+                self._load()
+        inputs = {i.name for i in self._session.get_inputs()}
+        vectors = [None] * len(texts)
+        # batch similar lengths together to keep padding short
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        for start in range(0, len(order), LOCAL_BATCH_SIZE):
+            batch = order[start:start + LOCAL_BATCH_SIZE]
+            encodings = self._tokenizer.encode_batch(
+                [texts[i] for i in batch])
+            ids = np.array([e.ids for e in encodings], dtype=np.int64)
+            mask = np.array([e.attention_mask for e in encodings],
+                            dtype=np.int64)
+            feed = {"input_ids": ids, "attention_mask": mask}
+            if "token_type_ids" in inputs:
+                feed["token_type_ids"] = np.zeros_like(ids)
+            # taken per batch, so a query waits for one batch of a large
+            # ingest request rather than all of it
+            with self._lock:
+                output = self._session.run(None, feed)[0]
+            if output.ndim == 3:
+                weights = mask[..., None].astype(np.float32)
+                output = (output * weights).sum(axis=1) / np.maximum(
+                    weights.sum(axis=1), 1)
+            if output.shape[1] != self.dims:
+                raise ValueError(
+                    f"{self.model} returns {output.shape[1]} dims, "
+                    f"EMBEDDING_DIMS is {self.dims}")
+            output /= np.maximum(
+                np.linalg.norm(output, axis=1, keepdims=True), 1e-12)
+            for i, vector in zip(batch, output.tolist()):
+                vectors[i] = vector
+        return vectors
+
+    async def embed(self, openai_client: AsyncOpenAI,
+                    texts: list[str]) -> list[list[float]]:
+        return await asyncio.to_thread(self._embed_sync, texts)
+
+
+class HashProvider:
+    """Deterministic embeddings from hashed words and word pairs.
+
+    Needs no model or network, so tests and benchmarks run offline and
+    reproducibly. Texts sharing words still land close to each other.
+    """
+
+    def __init__(self, dims: int):
+        self.model = "hash-v1"
+        self.dims = dims
+
+    def _embed_one(self, text: str) -> list[float]:
+        vector = [0.0] * self.dims
+        words = re.findall(r"\w+", text.lower())
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            digest = int.from_bytes(
+                hashlib.blake2b(feature.encode(), digest_size=8).digest())
+            vector[digest % self.dims] += 1.0 if digest >> 63 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    async def embed(self, openai_client: AsyncOpenAI,
+                    texts: list[str]) -> list[list[float]]:
+        return [self._embed_one(text) for text in texts]
+
+
+DEFAULT_DIMS = {"openai": 1536, "local": 384, "hash": 256}
+
+
+def provider_from_env():
+    """Build the provider named by EMBEDDING_PROVIDER (openai, local or hash)."""
+    name = os.getenv("EMBEDDING_PROVIDER", "openai")
+    if name not in DEFAULT_DIMS:
+        raise ValueError(f"Unknown EMBEDDING_PROVIDER {name!r}")
+    dims = int(os.getenv("EMBEDDING_DIMS", str(DEFAULT_DIMS[name])))
+    if name == "local":
+        return LocalProvider(LOCAL_MODEL_DIR, dims)
+    if name == "hash":
+        return HashProvider(dims)
+    return OpenAIProvider("text-embedding-3-small", dims)
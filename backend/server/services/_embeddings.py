@@ -0,0 +1,82 @@
+import asyncio
+import os
+
+import openai
+from openai import AsyncOpenAI
+
+from ._embedding_providers import provider_from_env
+
+PROVIDER = provider_from_env()
+# Cache key and index size of the configured provider's vectors; below its
+# native 1536 the OpenAI API shortens vectors
+MODEL = PROVIDER.model
+DIMS = PROVIDER.dims
+
+# Token budget of one embeddings request (the API allows 300k)
+BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "100000"))
+# Inputs per embeddings request (the API allows 2048)
+BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "512"))
+# Embeddings requests in flight at once
+CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+
+
+async def generate_embedding(openai_client: AsyncOpenAI, text: str) -> list[float]:
+    """Generate an embedding for the given text; provider errors are raised."""
+    return (await PROVIDER.embed(openai_client, [text]))[0]
+
+
+def _pack(items: list[tuple[str, str, int]]) -> list[list[tuple[str, str, int]]]:
+    """Group (uuid, text, token_count) items into requests under the budgets."""
+    batches = []
+    batch = []
+    tokens = 0
+    for item in items:
+        if batch and (tokens + item[2] > BATCH_TOKENS
+                      or len(batch) >= BATCH_SIZE):
+            batches.append(batch)
+            batch = []
+            tokens = 0
+        batch.append(item)
+        tokens += item[2]
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+async def generate_embeddings(
+    openai_client: AsyncOpenAI, items: list[tuple[str, str, int]]
+) -> tuple[dict[str, list[float]], set[str]]:
+    """Embed (uuid, text, token_count) items with the configured provider.
+
+    Items are packed into requests under BATCH_TOKENS / BATCH_SIZE and at
+    most CONCURRENCY requests run at once. Rate limits and transient errors
+    are retried with backoff; a rejected batch is split until the offending
+    item is isolated. Returns the embeddings by uuid and the failed uuids.
+    """
+    sem = asyncio.Semaphore(CONCURRENCY)
+    embeddings = {}
+    failed = set()
+
+    async def embed(batch):
+        try:
+            async with sem:
+                vectors = await PROVIDER.embed(openai_client,
+                                               [text for _, text, _ in batch])
+        except openai.BadRequestError as e:
+            if len(batch) > 1:
+                middle = len(batch) // 2
+                await asyncio.gather(embed(batch[:middle]),
+                                     embed(batch[middle:]))
+                return
+            print(f"Embedding rejected for {batch[0][0]}: {e}")
+            failed.add(batch[0][0])
+            return
+        except Exception as e:
+            print(f"Embedding batch of {len(batch)} failed: {e}")
+            failed.update(uuid for uuid, _, _ in batch)
+            return
+        for (uuid, _, _), vector in zip(batch, vectors):
+            embeddings[uuid] = vector
+
+    await asyncio.gather(*(embed(batch) for batch in _pack(items)))
+    return embeddings, failed
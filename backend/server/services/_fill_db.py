@@ -1,45 +1,266 @@
+import hashlib
+import io
+import json
+import time
+
 import psycopg2
 
-def fill_db(db_connection: psycopg2.extensions.connection, projects: list[dict]) -> int:
-    cur = db_connection.cursor()
+PROJECT_COLUMNS = [
+    "uuid", "slug", "emoji", "name", "tagline", "description", "how_its_made",
+    "source_code_url", "url", "event_name", "logo_url", "banner_url",
+    "screenshots", "video_file_url", "video_mux_url",
+    "video_mux_thumbnail_url", "video_youtube_id", "primary_repository_url"
+]
+
+PRIZE_COLUMNS = [
+    "project_uuid", "name", "pool_prize", "prize_name", "prize_emoji",
+    "prize_type", "sponsor_name", "sponsor_organization_name",
+    "sponsor_organization_square_logo_url"
+]
+
+_COPY_ESCAPES = str.maketrans({
+    "\\": "\\\\",
+    "\n": "\\n",
+    "\r": "\\r",
+    "\t": "\\t"
+})
+
+
+def _copy_value(value) -> str:
+    """Format a value for COPY's text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, list):
+        elements = []
+        for element in value:
+            if element is None:
+                elements.append("NULL")
+            else:
+                element = str(element).replace("\\", "\\\\").replace('"', '\\"')
+                elements.append(f'"{element}"')
+        value = "{" + ",".join(elements) + "}"
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def copy_rows(cur: psycopg2.extensions.cursor, table: str, columns: list[str],
+              rows) -> int:
+    """Stream rows into a table with a single COPY."""
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        buffer.write("\t".join(_copy_value(value) for value in row))
+        buffer.write("\n")
+        count += 1
+    buffer.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
+    return count
+
+
+def _media_fields(project: dict) -> tuple:
+    """Extract the media URLs that the links refresh keeps up to date."""
+    logo_url = ((project.get("logo") or {}).get("file") or {}).get("fullUrl")
+    banner_url = ((project.get("banner") or {}).get("file") or {}).get("fullUrl")
+
+    # Extract screenshots as array of URLs
+    screenshots = []
+    for screenshot in project.get("screenshots", []):
+        screenshot_url = ((screenshot.get("file") or {}).get("fullUrl"))
+        if screenshot_url:
+            screenshots.append(screenshot_url)
+
+    # Extract video information
+    video = project.get("video") or {}
+    video_file_url = ((video.get("file") or {}).get("fullUrl"))
+
+    # (name, square logo URL) of every prize that has a prize_name to match on
+    prize_logos = []
+    for prize in project.get("prizes", []):
+        prize_data = prize.get("prize", {}) or {}
+        sponsor = prize_data.get("sponsor") or {}
+        sponsor_org = sponsor.get("organization") or {}
+        if prize_data.get("name"):
+            prize_logos.append((prize.get("name", "") or "",
+                                (sponsor_org.get("squareLogo") or {}).get("fullUrl")))
+
+    return logo_url, banner_url, screenshots, video_file_url, prize_logos
+
+
+def _media_digest(media: tuple) -> str:
+    logo_url, banner_url, screenshots, video_file_url, prize_logos = media
+    payload = json.dumps([logo_url, banner_url, screenshots, video_file_url,
+                          sorted(prize_logos, key=lambda p: (p[0], p[1] or ""))])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _content_hash(project_row: tuple, prize_rows: list[tuple]) -> str:
+    """Hash of everything the search index and similarity are built from."""
+    project = dict(zip(PROJECT_COLUMNS, project_row))
+    # the square logo URL is media, tracked by the media digest instead
+    prizes = sorted(json.dumps(prize_row[:-1]) for prize_row in prize_rows)
+    payload = json.dumps([
+        project["name"], project["tagline"], project["description"],
+        project["how_its_made"], project["event_name"], prizes
+    ])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def content_hash(project: dict) -> str:
+    """The content hash fill_db stores for a downloaded project."""
+    row = _project_row(project)
+    prizes = [_prize_row(row[0], prize) for prize in project.get("prizes", [])]
+    return _content_hash(row, prizes)
+
+
+def _project_row(project: dict) -> tuple:
+    uuid = project.get("uuid")
+    slug = project.get("slug") or ""
+    emoji = project.get("emoji")
+    name = project.get("name") or ""
+    tagline = project.get("tagline", "") or ""
+    description = project.get("description", "") or ""
+    how_its_made = project.get("howItsMade", "") or ""
+    source_code_url = project.get("sourceCodeUrl")
+    url = project.get("url")
+    event_name = (project.get("event") or {}).get("name", "")
+    logo_url, banner_url, screenshots, video_file_url, _ = _media_fields(project)
+
+    # Extract video information
+    video = project.get("video") or {}
+    video_mux_url = video.get("muxUrl")
+    video_mux_thumbnail_url = video.get("muxThumbnailUrl")
+    video_youtube_id = video.get("youtubeId")
+
+    # Extract primary repository URL
+    primary_repository_url = ((project.get("primaryRepository") or {}).get("url"))
+
+    return (uuid, slug, emoji, name, tagline, description, how_its_made,
+            source_code_url, url, event_name, logo_url, banner_url,
+            screenshots, video_file_url, video_mux_url, video_mux_thumbnail_url,
+            video_youtube_id, primary_repository_url)
+
+
+def _prize_row(uuid: str, prize: dict) -> tuple:
+    name = prize.get("name", "") or ""
+    pool_prize = prize.get("poolPrize")
+    prize_data = prize.get("prize", {}) or {}
+
+    prize_name = prize_data.get("name")
+    prize_emoji = prize_data.get("emoji")
+    prize_type = prize_data.get("type")
+
+    sponsor = prize_data.get("sponsor") or {}
+    sponsor_name = sponsor.get("name")
+    sponsor_org = sponsor.get("organization") or {}
+    sponsor_organization_name = sponsor_org.get("name")
+    sponsor_organization_square_logo_url = ((sponsor_org.get("squareLogo") or {}).get("fullUrl"))
+
+    return (uuid, name, pool_prize, prize_name, prize_emoji, prize_type,
+            sponsor_name, sponsor_organization_name,
+            sponsor_organization_square_logo_url)
+
+
+def begin_ingest(db_connection: psycopg2.extensions.connection) -> int:
+    """Start an ingest run and return its generation number."""
+    with db_connection.cursor() as cur:
+        cur.execute("INSERT INTO ingest_run DEFAULT VALUES RETURNING generation")
+        generation = cur.fetchone()[0]
+    db_connection.commit()
+    return generation
+
+
+def finish_ingest(db_connection: psycopg2.extensions.connection,
+                  generation: int):
+    """Mark a run as complete once every stage has processed its dirty set."""
+    with db_connection.cursor() as cur:
+        cur.execute("UPDATE ingest_run SET finished_at = now() WHERE generation = %s",
+                    (generation,))
+    db_connection.commit()
+
+
+def bump_generation(db_connection: psycopg2.extensions.connection):
+    """Invalidate cached responses after the data they were built from changed.
+
+    Call only once the changes are committed: a response built from the old
+    data would otherwise be cached under the new generation.
+    """
+    with db_connection.cursor() as cur:
+        cur.execute("SELECT nextval('content_generation')")
+    db_connection.commit()
+
+
+def dirty_projects(db_connection: psycopg2.extensions.connection) -> set[str]:
+    """Uuids whose content changed since the last finished ingest run.
+
+    Changes from runs that failed before finishing stay dirty, so they are
+    picked up again by the next run, as do projects passed to mark_dirty.
+    """
+    with db_connection.cursor() as cur:
+        cur.execute("""
+            SELECT project_uuid
+            FROM project_digest
+            WHERE content_hash IS NULL
+               OR generation > (
+                SELECT COALESCE(MAX(generation), 0)
+                FROM ingest_run
+                WHERE finished_at IS NOT NULL
+            )
+        """)
+        return {row[0] for row in cur.fetchall()}
+
+
+def mark_dirty(db_connection: psycopg2.extensions.connection,
+               uuids: set[str]):
+    """Keep projects dirty after a stage failed to process them."""
+    with db_connection.cursor() as cur:
+        cur.execute("""
+            UPDATE project_digest SET content_hash = NULL
+            WHERE project_uuid = ANY(%s)
+        """, (list(uuids),))
+    db_connection.commit()
+
+
+def fill_db(db_connection: psycopg2.extensions.connection, projects: list[dict],
+            generation: int) -> int:
+    """Upsert projects and their prizes.
+
+    Rows are COPYed into temporary staging tables and merged with one
+    INSERT ... ON CONFLICT per table, all in a single transaction. Projects
+    whose content hash changed are stamped with `generation`.
+    """
+    start = time.perf_counter()
+
+    # Keyed by primary key, so a duplicate in the batch cannot make the
+    # merge update the same row twice
+    projects_rows = {}
+    prizes_rows = {}
     for project in projects:
-        uuid = project.get("uuid")
-        slug = project.get("slug") or ""
-        emoji = project.get("emoji")
-        name = project.get("name") or ""
-        tagline = project.get("tagline", "") or ""
-        description = project.get("description", "") or ""
-        how_its_made = project.get("howItsMade", "") or ""
-        source_code_url = project.get("sourceCodeUrl")
-        url = project.get("url")
-        event_name = (project.get("event") or {}).get("name", "")
-        logo_url = ((project.get("logo") or {}).get("file") or {}).get("fullUrl")
-        banner_url = ((project.get("banner") or {}).get("file") or {}).get("fullUrl")
-
-        # Extract screenshots as array of URLs
-        screenshots = []
-        for screenshot in project.get("screenshots", []):
-            screenshot_url = ((screenshot.get("file") or {}).get("fullUrl"))
-            if screenshot_url:
-                screenshots.append(screenshot_url)
-
-        # Extract video information
-        video = project.get("video") or {}
-        video_file_url = ((video.get("file") or {}).get("fullUrl"))
-        video_mux_url = video.get("muxUrl")
-        video_mux_thumbnail_url = video.get("muxThumbnailUrl")
-        video_youtube_id = video.get("youtubeId")
-
-        # Extract primary repository URL
-        primary_repository_url = ((project.get("primaryRepository") or {}).get("url"))
-
-        # Insert or update project
+        row = _project_row(project)
+        project_prizes = [_prize_row(row[0], prize) for prize in project.get("prizes", [])]
+        projects_rows[row[0]] = row + (_media_digest(_media_fields(project)),
+                                       _content_hash(row, project_prizes))
+        for prize_row in project_prizes:
+            prizes_rows[(prize_row[0], prize_row[1], prize_row[3])] = prize_row
+
+    project_columns = ", ".join(PROJECT_COLUMNS)
+    prize_columns = ", ".join(PRIZE_COLUMNS)
+    with db_connection.cursor() as cur:
         cur.execute("""
-            INSERT INTO project (uuid, slug, emoji, name, tagline, description, how_its_made, 
-                                source_code_url, url, event_name, logo_url, banner_url,
-                                screenshots, video_file_url, video_mux_url, video_mux_thumbnail_url,
-                                video_youtube_id, primary_repository_url)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            CREATE TEMP TABLE project_staging (
+                LIKE project,
+                media_digest VARCHAR(64),
+                content_hash VARCHAR(64)
+            ) ON COMMIT DROP;
+            CREATE TEMP TABLE prize_staging (LIKE prize) ON COMMIT DROP;
+        """)
+        copy_rows(cur, "project_staging",
+                  PROJECT_COLUMNS + ["media_digest", "content_hash"],
+                  projects_rows.values())
+        copy_rows(cur, "prize_staging", PRIZE_COLUMNS, prizes_rows.values())
+
+        # Insert or update projects
+        cur.execute(f"""
+            INSERT INTO project ({project_columns})
+            SELECT {project_columns} FROM project_staging
             ON CONFLICT (uuid) DO UPDATE
             SET slug = EXCLUDED.slug,
                 emoji = EXCLUDED.emoji,
@@ -58,100 +279,121 @@ def fill_db(db_connection: psycopg2.extensions.connection, projects: list[dict])
                 video_mux_thumbnail_url = EXCLUDED.video_mux_thumbnail_url,
                 video_youtube_id = EXCLUDED.video_youtube_id,
                 primary_repository_url = EXCLUDED.primary_repository_url
-        """, (uuid, slug, emoji, name, tagline, description, how_its_made,
-            source_code_url, url, event_name, logo_url, banner_url,
-            screenshots, video_file_url, video_mux_url, video_mux_thumbnail_url,
-            video_youtube_id, primary_repository_url))
+        """)
+        project_count = cur.rowcount
+
+        # The media URLs just written are what the links refresh compares
+        # to; the generation only moves when the content actually changed
+        cur.execute("""
+            INSERT INTO project_digest (project_uuid, media_digest,
+                                        content_hash, generation)
+            SELECT uuid, media_digest, content_hash, %s FROM project_staging
+            ON CONFLICT (project_uuid) DO UPDATE
+            SET media_digest = EXCLUDED.media_digest,
+                content_hash = EXCLUDED.content_hash,
+                generation = CASE
+                    WHEN project_digest.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+                    THEN EXCLUDED.generation
+                    ELSE project_digest.generation
+                END
+        """, (generation,))
 
-        # Insert prizes
-        prizes = project.get("prizes", [])
-        for prize in prizes:
-            name = prize.get("name", "") or ""
-            pool_prize = prize.get("poolPrize")
-            prize_data = prize.get("prize", {}) or {}
+        # Insert or update prizes
+        cur.execute(f"""
+            INSERT INTO prize ({prize_columns})
+            SELECT {prize_columns} FROM prize_staging
+            ON CONFLICT (project_uuid, name, prize_name) DO UPDATE
+            SET pool_prize = EXCLUDED.pool_prize,
+                prize_emoji = EXCLUDED.prize_emoji,
+                prize_type = EXCLUDED.prize_type,
+                sponsor_name = EXCLUDED.sponsor_name,
+                sponsor_organization_name = EXCLUDED.sponsor_organization_name,
+                sponsor_organization_square_logo_url = EXCLUDED.sponsor_organization_square_logo_url
+        """)
+        prize_count = cur.rowcount
 
-            prize_name = prize_data.get("name")
-            prize_emoji = prize_data.get("emoji")
-            prize_type = prize_data.get("type")
+    db_connection.commit()
+    elapsed = time.perf_counter() - start
+    print(f"Upserted {project_count} projects and {prize_count} prizes "
+          f"in {elapsed:.2f}s ({project_count / max(elapsed, 1e-9):.0f} projects/s)")
+    return project_count
+
+
+def fill_db_links(db_connection: psycopg2.extensions.connection,
+                  projects: list[dict]) -> tuple[int, int]:
+    """Refresh the media URLs of projects whose media changed.
 
-            sponsor = prize_data.get("sponsor") or {}
-            sponsor_name = sponsor.get("name")
-            sponsor_org = sponsor.get("organization") or {}
-            sponsor_organization_name = sponsor_org.get("name")
-            sponsor_organization_square_logo_url = ((sponsor_org.get("squareLogo") or {}).get("fullUrl"))
+    Each project's media is compared to the digest stored with it, and only
+    the changed ones are written, with one UPDATE ... FROM a staging table
+    per table. Returns the number of updated and skipped projects.
+    """
+    media = {project.get("uuid"): _media_fields(project) for project in projects}
+    digests = {uuid: _media_digest(fields) for uuid, fields in media.items()}
 
+    with db_connection.cursor() as cur:
+        cur.execute("""
+            SELECT project_uuid, media_digest
+            FROM project_digest
+            WHERE project_uuid = ANY(%s)
+        """, (list(media),))
+        stored = dict(cur.fetchall())
+        changed = [uuid for uuid in media if stored.get(uuid) != digests[uuid]]
+
+        updated = 0
+        if changed:
             cur.execute("""
-                INSERT INTO prize (project_uuid, name, pool_prize, prize_name, prize_emoji, 
-                                  prize_type, sponsor_name, sponsor_organization_name, 
-                                  sponsor_organization_square_logo_url)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (project_uuid, name, prize_name) DO UPDATE
-                SET pool_prize = EXCLUDED.pool_prize,
-                    prize_emoji = EXCLUDED.prize_emoji,
-                    prize_type = EXCLUDED.prize_type,
-                    sponsor_name = EXCLUDED.sponsor_name,
-                    sponsor_organization_name = EXCLUDED.sponsor_organization_name,
-                    sponsor_organization_square_logo_url = EXCLUDED.sponsor_organization_square_logo_url
-            """, (uuid, name, pool_prize, prize_name, prize_emoji, prize_type,
-                sponsor_name, sponsor_organization_name, sponsor_organization_square_logo_url))
+                CREATE TEMP TABLE media_staging (
+                    uuid VARCHAR(255),
+                    logo_url TEXT,
+                    banner_url TEXT,
+                    screenshots TEXT[],
+                    video_file_url TEXT,
+                    media_digest VARCHAR(64)
+                ) ON COMMIT DROP;
+                CREATE TEMP TABLE prize_media_staging (
+                    project_uuid VARCHAR(255),
+                    name VARCHAR,
+                    sponsor_organization_square_logo_url TEXT
+                ) ON COMMIT DROP;
+            """)
+            copy_rows(cur, "media_staging", [
+                "uuid", "logo_url", "banner_url", "screenshots",
+                "video_file_url", "media_digest"
+            ], ((uuid, *media[uuid][:4], digests[uuid]) for uuid in changed))
+            copy_rows(cur, "prize_media_staging", [
+                "project_uuid", "name", "sponsor_organization_square_logo_url"
+            ], ((uuid, name, url) for uuid in changed
+                for name, url in media[uuid][4]))
 
-    db_connection.commit()
-    cur.close()
-    return len(projects)
+            cur.execute("""
+                UPDATE project p SET
+                    logo_url = s.logo_url,
+                    banner_url = s.banner_url,
+                    screenshots = s.screenshots,
+                    video_file_url = s.video_file_url
+                FROM media_staging s
+                WHERE p.uuid = s.uuid
+            """)
+            updated = cur.rowcount
 
+            # Update prizes with square logo URLs
+            cur.execute("""
+                UPDATE prize p SET
+                    sponsor_organization_square_logo_url = s.sponsor_organization_square_logo_url
+                FROM prize_media_staging s
+                WHERE p.project_uuid = s.project_uuid
+                  AND p.name = s.name
+                  AND p.sponsor_organization_square_logo_url
+                      IS DISTINCT FROM s.sponsor_organization_square_logo_url
+            """)
 
-def fill_db_links(db_connection: psycopg2.extensions.connection,
-                  projects: list[dict]) -> int:
-    cur = db_connection.cursor()
-    for project in projects:
-        uuid = project.get("uuid")
-        logo_url = ((project.get("logo") or {}).get("file")
-                    or {}).get("fullUrl")
-        banner_url = ((project.get("banner") or {}).get("file")
-                      or {}).get("fullUrl")
-
-        # Extract screenshots as array of URLs
-        screenshots = []
-        for screenshot in project.get("screenshots", []):
-            screenshot_url = ((screenshot.get("file") or {}).get("fullUrl"))
-            if screenshot_url:
-                screenshots.append(screenshot_url)
-
-        # Extract video information
-        video = project.get("video") or {}
-        video_file_url = ((video.get("file") or {}).get("fullUrl"))
-
-        cur.execute(
-            """
-            UPDATE project SET 
-                logo_url = %s, 
-                banner_url = %s,
-                screenshots = %s,
-                video_file_url = %s
-            WHERE uuid = %s
-        """, (logo_url, banner_url, screenshots, video_file_url, uuid))
-
-        # Update prizes with square logo URLs
-        prizes = project.get("prizes", [])
-        for prize in prizes:
-            name = prize.get("name", "") or ""
-            prize_data = prize.get("prize", {}) or {}
-            sponsor = prize_data.get("sponsor") or {}
-            sponsor_org = sponsor.get("organization") or {}
-            sponsor_organization_square_logo_url = ((
-                sponsor_org.get("squareLogo") or {}).get("fullUrl"))
-            # Get prize_name for the conflict resolution
-            prize_name = prize_data.get("name")
-
-            if prize_name:  # Only update if we have a prize_name to match on
-                cur.execute(
-                    """
-                    UPDATE prize SET 
-                        sponsor_organization_square_logo_url = %s
-                    WHERE project_uuid = %s 
-                      AND name = %s 
-                """, (sponsor_organization_square_logo_url, uuid, name))
+            cur.execute("""
+                INSERT INTO project_digest (project_uuid, media_digest)
+                SELECT s.uuid, s.media_digest
+                FROM media_staging s JOIN project p ON p.uuid = s.uuid
+                ON CONFLICT (project_uuid) DO UPDATE
+                SET media_digest = EXCLUDED.media_digest
+            """)
 
     db_connection.commit()
-    cur.close()
-    return len(projects)
+    return updated, len(media) - len(changed)
@@ -1,100 +1,284 @@
+import asyncio
+import os
+
 import psycopg2
 import elasticsearch
-from elasticsearch import NotFoundError
+from elasticsearch import helpers
 from openai import AsyncOpenAI
-import tiktoken
+
+from ._embedding_cache import (get_cached_embeddings, put_cached_embeddings,
+                               record_text_hashes, text_hash)
+from ._embeddings import DIMS, MODEL, generate_embedding, generate_embeddings
+from ._fill_db import mark_dirty
+from ._index_versions import create_version, gc_versions, live_index, swap_alias
+from ._text_prep import prepare_texts, shorten_text
 
 
 INDEX = "documents"
 
-MAPPING = {
-    "mappings": {
-        "properties": {
-            "name": {"type": "text"},
-            "tagline": {"type": "text"},
-            "description": {"type": "text"},
-            "how_its_made": {"type": "text"},
-            "event_name": {
-                "type": "keyword"
-            },
-            "type": {
-                "type": "keyword"
-            },
-            "sponsor_organization": {
-                "type": "keyword"
-            },
-            "embedding": {
-                "type": "dense_vector",
-                "dims": 1536,
-                "index": True,
-                "similarity": "cosine",
-            },
-            "raw_embedding": {
-                "type": "float"
-            }
+# "full" keeps a float copy of every vector in _source next to the HNSW
+# field; "compact" stores one quantized vector and leaves it out of _source
+VECTOR_MODE = os.getenv("ES_VECTOR_MODE", "full")
+# Quantization of the compact vector field: int8_hnsw, int4_hnsw or bbq_hnsw
+VECTOR_INDEX_TYPE = os.getenv("ES_VECTOR_INDEX_TYPE", "int8_hnsw")
+
+
+def build_mapping(mode: str = VECTOR_MODE, dims: int = DIMS) -> dict:
+    """Return the index mapping for the given vector storage mode."""
+    embedding = {
+        "type": "dense_vector",
+        "dims": dims,
+        "index": True,
+        "similarity": "cosine",
+    }
+    properties = {
+        "name": {"type": "text"},
+        "tagline": {"type": "text"},
+        "description": {"type": "text"},
+        "how_its_made": {"type": "text"},
+        "event_name": {
+            "type": "keyword"
+        },
+        "type": {
+            "type": "keyword"
+        },
+        "sponsor_organization": {
+            "type": "keyword"
+        },
+        "embedding": embedding,
+        "text_hash": {
+            "type": "keyword",
+            "index": False
         }
     }
+    # vectors of different models don't compare, so the index records its own
+    meta = {"embedding_model": MODEL}
+    if mode == "compact":
+        embedding["index_options"] = {"type": VECTOR_INDEX_TYPE}
+        # vectors are read back from the embedding cache, not from _source
+        return {
+            "mappings": {
+                "_meta": meta,
+                "_source": {"excludes": ["embedding"]},
+                "properties": properties
+            }
+        }
+    properties["raw_embedding"] = {"type": "float"}
+    return {"mappings": {"_meta": meta, "properties": properties}}
+
+
+MAPPING = build_mapping()
+
+# Projects prepared, embedded and indexed per round, bounding memory
+CHUNK_SIZE = int(os.getenv("FILL_SEARCH_CHUNK_SIZE", "2000"))
+# Documents per bulk request and bulk requests in flight
+BULK_CHUNK_SIZE = int(os.getenv("ES_BULK_CHUNK_SIZE", "500"))
+BULK_THREADS = int(os.getenv("ES_BULK_THREADS", "4"))
+# Documents per mget when looking up stored text hashes
+MGET_CHUNK_SIZE = int(os.getenv("ES_MGET_CHUNK_SIZE", "1000"))
+# Settings of a serving index, and of a new version while it is loaded
+INDEX_SETTINGS = {
+    "index.refresh_interval": os.getenv("ES_REFRESH_INTERVAL", "1s"),
+    "index.number_of_replicas": int(os.getenv("ES_NUMBER_OF_REPLICAS", "1")),
+}
+BULK_LOAD_SETTINGS = {
+    "index.refresh_interval": "-1",
+    "index.number_of_replicas": 0,
 }
 
 
-def shorten_text(text: str) -> str:
-    encoding = tiktoken.encoding_for_model("text-embedding-3-small")
-    MAX_TOKENS = 8000
-    tokens = encoding.encode(text)
-    if len(tokens) > MAX_TOKENS:
-        truncated_tokens = tokens[:MAX_TOKENS]
-        return encoding.decode(truncated_tokens)
-    return text
-
-
-async def generate_embedding(openai_client: AsyncOpenAI,
-                             text: str) -> list[float]:
-    """Generate an embedding for the given text."""
-    try:
-        response = await openai_client.embeddings.create(
-            model="text-embedding-3-small", input=text)
-        return response.data[0].embedding
-    except Exception as e:
-        return [0]
-
-
-async def ensure_index(es: elasticsearch.Elasticsearch):
-    """Create the index if it doesn't exist."""
-    # es.indices.delete(index=INDEX, ignore=[404])
-    if not es.indices.exists(index=INDEX):
-        es.indices.create(index=INDEX, body=MAPPING)
+def ensure_index(es: elasticsearch.Elasticsearch):
+    """Create the first index version behind the alias if there is none."""
+    live = live_index(es, INDEX)
+    if live is None:
+        swap_alias(es, INDEX, create_version(es, INDEX, MAPPING, INDEX_SETTINGS))
         return
+    # new fields can be added to an existing index in place
+    es.indices.put_mapping(index=live, properties={
+        "text_hash": MAPPING["mappings"]["properties"]["text_hash"]
+    })
+    # undoes bulk-load settings an interrupted load may have left behind
+    es.indices.put_settings(index=live, settings=INDEX_SETTINGS)
+
+
+def needs_rebuild(es: elasticsearch.Elasticsearch) -> bool:
+    """Whether the live index's vector layout differs from MAPPING.
+
+    The vector layout can't be changed in place, only by a rebuild. An index
+    that predates versioning is rebuilt to move it behind the alias.
+    """
+    live = live_index(es, INDEX)
+    if live is None:
+        return False
+    if live == INDEX:
+        return True
+    current = next(iter(es.indices.get_mapping(index=live).values()))["mappings"]
+    return _vector_layout(current, MAPPING["mappings"]) != _vector_layout(
+        MAPPING["mappings"], MAPPING["mappings"])
+
+
+def _live_vectors(es: elasticsearch.Elasticsearch
+                  ) -> tuple[str | None, str | None, int | None, bool]:
+    """Return the live index, the embedding model and dims of its vectors,
+    and whether it keeps a copy of them in _source."""
+    live = live_index(es, INDEX)
+    if live is None:
+        return None, None, None, False
+    mappings = next(iter(es.indices.get_mapping(index=live).values()))["mappings"]
+    properties = mappings.get("properties", {})
+    dims = properties.get("embedding", {}).get("dims")
+    return live, _embedding_model(mappings), dims, "raw_embedding" in properties
+
+
+def _embedding_model(mappings: dict) -> str:
+    # indices from before the model was recorded hold OpenAI vectors
+    return mappings.get("_meta", {}).get("embedding_model",
+                                         "text-embedding-3-small")
+
+
+def _vector_layout(mappings: dict, wanted: dict) -> tuple:
+    """The parts of a mapping that decide how vectors are stored.
+
+    Index options are only compared when `wanted` sets them, as
+    Elasticsearch reports its defaults for fields that don't.
+    """
+    properties = mappings.get("properties", {})
+    embedding = properties.get("embedding", {})
+    index_type = None
+    if "index_options" in wanted["properties"]["embedding"]:
+        index_type = embedding.get("index_options", {}).get("type")
+    return (_embedding_model(mappings),
+            embedding.get("dims"), embedding.get("similarity"), index_type,
+            "raw_embedding" in properties,
+            mappings.get("_source", {}).get("excludes", []))
+
+
+def finish_bulk_load(es: elasticsearch.Elasticsearch, index: str):
+    """Give an index loaded with BULK_LOAD_SETTINGS its serving settings.
+
+    The configured values are applied rather than any read back from the
+    index, and the index is refreshed once, so loaded documents become
+    searchable together.
+    """
+    es.indices.put_settings(index=index, settings=INDEX_SETTINGS)
+    es.indices.refresh(index=index)
+
+
+def index_documents(es: elasticsearch.Elasticsearch, index: str,
+                    docs: dict[str, dict]) -> tuple[int, dict[str, str]]:
+    """Index documents with the bulk API.
+
+    Returns the number indexed and the error of every document that was
+    not, keyed by id.
+    """
+    actions = ({
+        "_index": index,
+        "_id": uuid,
+        "_source": doc
+    } for uuid, doc in docs.items())
+    indexed = 0
+    errors = {}
+    for ok, info in helpers.parallel_bulk(es,
+                                          actions,
+                                          thread_count=BULK_THREADS,
+                                          chunk_size=BULK_CHUNK_SIZE,
+                                          raise_on_error=False,
+                                          raise_on_exception=False):
+        if ok:
+            indexed += 1
+        else:
+            item = next(iter(info.values()))
+            errors[item.get("_id")] = str(item.get("error") or item.get("exception"))
+    return indexed, errors
+
+
+def fetch_text_hashes(es: elasticsearch.Elasticsearch, index: str,
+                      uuids: list[str]) -> dict[str, str]:
+    """Return the stored text hash of every indexed document among uuids.
 
-async def fetch_existing_doc(es, uuid):
-    """Return existing doc source or None."""
-    try:
-        return es.get(index=INDEX, id=uuid)
-    except NotFoundError:
-        return None
+    Documents indexed before text hashes existed get one computed from their
+    stored text, so they can still reuse their embedding.
+    """
+    hashes = {}
+    missing = []
+    for start in range(0, len(uuids), MGET_CHUNK_SIZE):
+        res = es.mget(index=index,
+                      ids=uuids[start:start + MGET_CHUNK_SIZE],
+                      source_includes=["text_hash"])
+        for doc in res["docs"]:
+            if not doc.get("found"):
+                continue
+            if doc["_source"].get("text_hash"):
+                hashes[doc["_id"]] = doc["_source"]["text_hash"]
+            else:
+                missing.append(doc["_id"])
+
+    fields = ["name", "tagline", "description", "how_its_made"]
+    for start in range(0, len(missing), MGET_CHUNK_SIZE):
+        res = es.mget(index=index,
+                      ids=missing[start:start + MGET_CHUNK_SIZE],
+                      source_includes=fields)
+        for doc in res["docs"]:
+            if doc.get("found"):
+                parts = [doc["_source"].get(field) for field in fields]
+                full_text, _ = shorten_text("\n".join(filter(None, parts)))
+                hashes[doc["_id"]] = text_hash(full_text)
+    return hashes
+
+
+def fetch_embeddings(es: elasticsearch.Elasticsearch, index: str,
+                     uuids: list[str]) -> dict[str, list[float]]:
+    """Return the embeddings stored in _source, only kept in full mode."""
+    embeddings = {}
+    for start in range(0, len(uuids), MGET_CHUNK_SIZE):
+        res = es.mget(index=index,
+                      ids=uuids[start:start + MGET_CHUNK_SIZE],
+                      source_includes=["raw_embedding"])
+        for doc in res["docs"]:
+            if doc.get("found") and doc["_source"].get("raw_embedding"):
+                embeddings[doc["_id"]] = doc["_source"]["raw_embedding"]
+    return embeddings
 
 
 async def fill_search(db_connection: psycopg2.extensions.connection,
                       es: elasticsearch.Elasticsearch,
-                      openai_client: AsyncOpenAI) -> int:
+                      openai_client: AsyncOpenAI,
+                      uuids: set[str] | None = None,
+                      index: str | None = None) -> int:
+    """Index projects into Elasticsearch, only `uuids` if given.
 
-    await ensure_index(es)
+    Documents go to the live index unless another `index` is given; stored
+    text hashes and vectors are always looked up in the live one.
+    """
 
-    with db_connection.cursor() as cur:
-        # Fetch projects with event_name
-        cur.execute("""
-            SELECT uuid, name, tagline, description, how_its_made, event_name
-            FROM project
-            ORDER BY uuid
-        """)
-        projects = cur.fetchall()
-
-        # Fetch all prizes grouped by project
-        cur.execute("""
-            SELECT project_uuid, prize_type, sponsor_organization_name
-            FROM prize
-            ORDER BY project_uuid
-        """)
-        prizes = cur.fetchall()
+    if index is None:
+        await asyncio.to_thread(ensure_index, es)
+        index = INDEX
+    live, live_model, live_dims, live_raw = await asyncio.to_thread(
+        _live_vectors, es)
+
+    # sync DB fetch in a background thread, off the event loop
+    def fetch_projects():
+        with db_connection.cursor() as cur:
+            # Fetch projects with event_name
+            cur.execute("""
+                SELECT uuid, name, tagline, description, how_its_made, event_name
+                FROM project
+                WHERE %(all)s OR uuid = ANY(%(uuids)s)
+                ORDER BY uuid
+            """, {"all": uuids is None, "uuids": list(uuids or [])})
+            projects = cur.fetchall()
+
+            # Fetch all prizes grouped by project
+            cur.execute("""
+                SELECT project_uuid, prize_type, sponsor_organization_name
+                FROM prize
+                WHERE %(all)s OR project_uuid = ANY(%(uuids)s)
+                ORDER BY project_uuid
+            """, {"all": uuids is None, "uuids": list(uuids or [])})
+            return projects, cur.fetchall()
+
+    projects, prizes = await asyncio.to_thread(fetch_projects)
 
     # Build a map of project_uuid -> set of (type, sponsor_organization)
     prizes_map = {}
@@ -106,66 +290,148 @@ async def fill_search(db_connection: psycopg2.extensions.connection,
         if sponsor_org:
             prizes_map[project_uuid]["orgs"].add(sponsor_org)
 
-    for uuid, name, tagline, description, how_its_made, event_name in projects:
-        print(uuid)
-        existing = await fetch_existing_doc(es, uuid)
-
-        # Get prize data for this project
-        prize_data = prizes_map.get(uuid, {"types": set(), "orgs": set()})
-        prize_types = sorted(list(
-            prize_data["types"]))  # Convert to sorted list for consistency
-        sponsor_orgs = sorted(list(prize_data["orgs"]))
-
-        # prepare full text for embedding
-        parts = [name, tagline, description, how_its_made]
-        full_text = "\n".join(filter(None, parts))
-        full_text = shorten_text(full_text)
-
-        # Check if we can reuse the existing embedding
-        should_reuse_embedding = False
-        if existing and existing['_source']:
-            original_parts = []
-            original_parts.append(existing['_source'].get('name'))
-            original_parts.append(existing['_source'].get('tagline'))
-            original_parts.append(existing['_source'].get('description'))
-            original_parts.append(existing['_source'].get('how_its_made'))
-            original_full_text = "\n".join(filter(None, parts))
-            original_full_text = shorten_text(original_full_text)
-            # Reuse embedding if text hasn't changed and embedding exists
-            if original_full_text == full_text and existing['_source'].get(
-                    'raw_embedding') is not None:
-                should_reuse_embedding = True
-                embedding = existing['_source']['raw_embedding']
-
-        # Generate new embedding if we can't reuse
-        if not should_reuse_embedding:
-            print("Generating new embedding, uuid: ", uuid, flush=True)
-            embedding = await generate_embedding(openai_client, full_text)
-
-        # Always build and index the document with all current fields
-        doc = {
-            "name": name,
-            "tagline": tagline,
-            "description": description,
-            "how_its_made": how_its_made,
-            "event_name": event_name,
-            "type": prize_types,
-            "sponsor_organization": sponsor_orgs,
-            "embedding": embedding,
-            "raw_embedding": embedding
-        }
-        try:
-            # Index the document with refresh=False for better performance
-            result = es.index(index=INDEX, id=uuid, document=doc, refresh=True)
-        except Exception as e:
-            print(f"Error indexing document {uuid}: {e}")
-            raise
-
-    # Refresh the index once after all documents are indexed
-    try:
-        es.indices.refresh(index=INDEX)
-    except Exception as e:
-        print(f"Error refreshing index: {e}")
-        raise
-
-    return len(projects)
+    indexed = 0
+    failed = set()
+
+    for start in range(0, len(projects), CHUNK_SIZE):
+        chunk = projects[start:start + CHUNK_SIZE]
+        stored_hashes = {}
+        if live:
+            stored_hashes = await asyncio.to_thread(
+                fetch_text_hashes, es, live, [project[0] for project in chunk])
+
+        # Tokenize and truncate the chunk's texts off the event loop
+        prepared = await prepare_texts([
+            (uuid, "\n".join(filter(None, [name, tagline, description, how_its_made])))
+            for uuid, name, tagline, description, how_its_made, _ in chunk
+        ])
+
+        docs = {}
+        for (uuid, name, tagline, description, how_its_made, event_name), (_, full_text, _) in zip(chunk, prepared):
+            # Get prize data for this project
+            prize_data = prizes_map.get(uuid, {"types": set(), "orgs": set()})
+            prize_types = sorted(list(
+                prize_data["types"]))  # Convert to sorted list for consistency
+            sponsor_orgs = sorted(list(prize_data["orgs"]))
+
+            # Always build and index the document with all current fields
+            docs[uuid] = {
+                "name": name,
+                "tagline": tagline,
+                "description": description,
+                "how_its_made": how_its_made,
+                "event_name": event_name,
+                "type": prize_types,
+                "sponsor_organization": sponsor_orgs,
+                "text_hash": text_hash(full_text),
+            }
+
+        # Look everything up in the embedding cache first; only texts
+        # that were never embedded before cost an API call
+        hashes = {uuid: doc["text_hash"] for uuid, doc in docs.items()}
+        cached = await asyncio.to_thread(get_cached_embeddings,
+                                         db_connection,
+                                         list(set(hashes.values())),
+                                         MODEL, DIMS)
+        uncached = {uuid for uuid in docs if hashes[uuid] not in cached}
+
+        # An unchanged text whose vector only the index has so far is
+        # copied from _source, when the live index keeps one there of the
+        # same model and width, whichever layout the new documents get
+        backfill = {}
+        if live_model == MODEL and live_dims == DIMS and live_raw:
+            backfill = await asyncio.to_thread(
+                fetch_embeddings, es, live, [
+                    uuid for uuid in uncached
+                    if stored_hashes.get(uuid) == hashes[uuid]
+                ])
+        to_generate = [
+            item for item in prepared
+            if item[0] in uncached and item[0] not in backfill
+        ]
+        print(f"Generating {len(to_generate)} new embeddings, "
+              f"{len(docs) - len(uncached)} from cache, "
+              f"{len(backfill)} from the index", flush=True)
+        embeddings, chunk_failed = await generate_embeddings(
+            openai_client, to_generate)
+        failed.update(chunk_failed)
+
+        embeddings |= backfill
+        await asyncio.to_thread(
+            put_cached_embeddings, db_connection, {
+                hashes[uuid]: embedding
+                for uuid, embedding in embeddings.items()
+            }, MODEL, DIMS)
+
+        for uuid in chunk_failed:
+            del docs[uuid]
+        for uuid, doc in docs.items():
+            embedding = embeddings.get(uuid) or cached[hashes[uuid]]
+            doc["embedding"] = embedding
+            if VECTOR_MODE != "compact":
+                doc["raw_embedding"] = embedding
+
+        chunk_indexed, errors = await asyncio.to_thread(
+            index_documents, es, index, docs)
+        indexed += chunk_indexed
+        for uuid, error in errors.items():
+            print(f"Error indexing document {uuid}: {error}")
+        failed.update(errors)
+
+        # Point the side store at the vectors the index now holds
+        await asyncio.to_thread(
+            record_text_hashes, db_connection, {
+                uuid: hashes[uuid]
+                for uuid in docs if uuid not in errors
+            })
+
+        print(f"Indexed {indexed}/{len(projects)} projects", flush=True)
+
+    # documents become searchable together, at one refresh
+    await asyncio.to_thread(es.indices.refresh, index=index)
+
+    # Projects that were not indexed are picked up again by the next run
+    if failed:
+        print(f"Failed to index {len(failed)} projects: {sorted(failed)}")
+        await asyncio.to_thread(mark_dirty, db_connection, failed)
+
+    return indexed
+
+
+async def rebuild_search(db_connection: psycopg2.extensions.connection,
+                         es: elasticsearch.Elasticsearch,
+                         openai_client: AsyncOpenAI) -> bool:
+    """Index every project into a new index version, then switch to it.
+
+    Queries keep hitting the live index until the new one holds a document
+    for every project; a rebuild that falls short is dropped instead.
+    """
+    # a new version isn't served yet, so it loads without refreshes or
+    # replicas, and an interrupted load never leaves them off a live index
+    index = await asyncio.to_thread(create_version, es, INDEX, MAPPING,
+                                    BULK_LOAD_SETTINGS)
+    print(f"Rebuilding {INDEX} into {index}", flush=True)
+    await fill_search(db_connection, es, openai_client, index=index)
+    await asyncio.to_thread(finish_bulk_load, es, index)
+    return await asyncio.to_thread(_switch_to, db_connection, es, index)
+
+
+def _switch_to(db_connection: psycopg2.extensions.connection,
+               es: elasticsearch.Elasticsearch, index: str) -> bool:
+    """Swap a rebuilt index in if it is complete, or drop it."""
+    with db_connection.cursor() as cur:
+        cur.execute("SELECT count(*) FROM project")
+        expected = cur.fetchone()[0]
+    count = es.count(index=index)["count"]
+    if count != expected:
+        print(f"Rebuild of {index} has {count}/{expected} documents, "
+              f"keeping {live_index(es, INDEX)}", flush=True)
+        es.indices.delete(index=index, ignore_unavailable=True)
+        return False
+
+    swap_alias(es, INDEX, index)
+    print(f"Switched {INDEX} to {index}", flush=True)
+    stale = gc_versions(es, INDEX)
+    if stale:
+        print(f"Deleted old versions {stale}")
+    return True
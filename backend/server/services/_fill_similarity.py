@@ -1,106 +1,379 @@
 import asyncio
-from typing import List, Tuple
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import shared_memory
 
+import numpy as np
 import psycopg2
-from elasticsearch import AsyncElasticsearch
+from psycopg2.extras import execute_values
 
+from ._embeddings import DIMS, MODEL
 
-async def fetch_embedding(es: AsyncElasticsearch, index: str, uuid_1: str):
+# Neighbors kept per project
+TOP_K = int(os.getenv("SIMILARITY_TOP_K", "30"))
+# Rows scored per matrix multiply; a block takes BLOCK_SIZE x projects floats
+BLOCK_SIZE = int(os.getenv("SIMILARITY_BLOCK_SIZE", "512"))
+# Worker processes scoring row blocks, started per run and each importing
+# the entry script again; with more than one, set OPENBLAS_NUM_THREADS=1
+# (or OMP_NUM_THREADS) so they don't oversubscribe
+WORKERS = int(os.getenv("SIMILARITY_WORKERS", "1"))
+# Length of the neighbor list kept per project for /similar
+NEIGHBORS = int(os.getenv("SIMILARITY_NEIGHBORS", "20"))
+
+
+def load_embedding_matrix(db_connection: psycopg2.extensions.connection,
+                          model: str = MODEL,
+                          dims: int = DIMS) -> tuple[list[str], np.ndarray]:
+    """Return the project uuids and their normalized float32 embeddings."""
+    with db_connection.cursor() as cur:
+        cur.execute("""
+            SELECT d.project_uuid, c.embedding
+            FROM project_digest d
+            JOIN embedding_cache c
+              ON c.text_hash = d.text_hash AND c.model = %s AND c.dims = %s
+             AND octet_length(c.embedding) = %s
+        """, (model, dims, dims * 4))
+        # row order follows uuid order, so pairs can be ordered by row
+        rows = sorted(cur.fetchall())
+    matrix = np.empty((len(rows), dims), dtype=np.float32)
+    for i, (_, embedding) in enumerate(rows):
+        matrix[i] = np.frombuffer(embedding, dtype="<f4")
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix /= np.maximum(norms, 1e-12)
+    return [row[0] for row in rows], matrix
+
+
+def _top_k_block(matrix: np.ndarray, block: np.ndarray,
+                 k: int) -> tuple[np.ndarray, np.ndarray]:
+    sims = matrix[block] @ matrix.T
+    sims[np.arange(len(block)), block] = -np.inf
+    part = np.argpartition(sims, -k, axis=1)[:, -k:]
+    part_sims = np.take_along_axis(sims, part, axis=1)
+    order = np.argsort(-part_sims, axis=1)
+    return (np.take_along_axis(part, order, axis=1),
+            np.take_along_axis(part_sims, order, axis=1))
+
+
+# The matrix a pool worker scores against, attached once per process
+_shared: tuple[shared_memory.SharedMemory, np.ndarray] | None = None
+
+
+def _attach(name: str, shape: tuple[int, int]):
+    global _shared
+    # the parent owns and unlinks the segment
+    memory = shared_memory.SharedMemory(name=name, track=False)
+    _shared = memory, np.ndarray(shape, dtype=np.float32, buffer=memory.buf)
+
+
+def _top_k_shared(block: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    return _top_k_block(_shared[1], block, k)
+
+
+def _blocks(rows: np.ndarray, matrix: np.ndarray, k: int, block_size: int,
+            workers: int):
+    """Yield (start, neighbors, cosines) of each row block as it completes.
+
+    With several workers, blocks are scored on a process pool that reads
+    the matrix from shared memory instead of receiving a copy.
+    """
+    starts = range(0, len(rows), block_size)
+    if workers <= 1 or len(starts) <= 1:
+        for start in starts:
+            yield start, *_top_k_block(matrix, rows[start:start + block_size], k)
+        return
+    memory = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
     try:
-        doc = es.get(index=index, id=uuid_1)
-    except Exception:
-        return None
-    return doc["_source"].get("raw_embedding")
+        np.ndarray(matrix.shape, dtype=np.float32, buffer=memory.buf)[:] = matrix
+        # spawn, since forking a process that runs threads is unsafe
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_attach,
+                initargs=(memory.name, matrix.shape)) as pool:
+            futures = {
+                pool.submit(_top_k_shared, rows[start:start + block_size], k): start
+                for start in starts
+            }
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    yield futures[future], *future.result()
+            finally:
+                # an abandoned generator drops the blocks not started yet
+                pool.shutdown(cancel_futures=True)
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+def top_k(matrix: np.ndarray, rows: np.ndarray, k: int = TOP_K,
+          block_size: int = BLOCK_SIZE,
+          workers: int = WORKERS,
+          cancel: threading.Event | None = None
+          ) -> tuple[np.ndarray, np.ndarray]:
+    """Return the k nearest neighbors of each of `rows` and their cosines.
+
+    Rows are scored against the whole matrix a block at a time, so memory
+    stays at block_size x len(matrix) scores per worker. Neighbor indices
+    come back sorted by decreasing similarity; a row never neighbors itself.
+    Setting `cancel` stops the computation after the current block.
+    """
+    k = min(k, len(matrix) - 1)
+    neighbors = np.empty((len(rows), max(k, 0)), dtype=np.int64)
+    scores = np.empty((len(rows), max(k, 0)), dtype=np.float32)
+    if k <= 0:
+        return neighbors, scores
+    done = 0
+    for start, block_neighbors, block_scores in _blocks(rows, matrix, k,
+                                                        block_size, workers):
+        if cancel is not None and cancel.is_set():
+            raise concurrent.futures.CancelledError("similarity cancelled")
+        neighbors[start:start + len(block_neighbors)] = block_neighbors
+        scores[start:start + len(block_scores)] = block_scores
+        done += len(block_neighbors)
+        print(f"Scored {done}/{len(rows)} rows", flush=True)
+    return neighbors, scores
+
+
+def reverse_neighbors(matrix: np.ndarray, rows: np.ndarray, kth: np.ndarray,
+                      block_size: int = BLOCK_SIZE,
+                      tolerance: float = 0.0
+                      ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Find the projects whose top-k lists `rows` now belong in.
 
+    A row enters another project's list when it is closer to it than that
+    project's k-th neighbor (`kth`, cosines per matrix row), or within
+    `tolerance` of it to include rows that are the k-th neighbor. Returns
+    the (row, project, cosine) triples as arrays.
+    """
+    sources, targets, cosines = [], [], []
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        sims = matrix[block] @ matrix.T
+        sims[np.arange(len(block)), block] = -np.inf
+        i, j = np.nonzero(sims > kth - tolerance)
+        sources.append(block[i])
+        targets.append(j)
+        cosines.append(sims[i, j])
+    if not sources:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=np.float32))
+    return np.concatenate(sources), np.concatenate(targets), np.concatenate(cosines)
 
-async def knn_search(es: AsyncElasticsearch, index: str, embedding):
-    return es.search(
-        index=index,
-        knn={
-            "field": "embedding",
-            "query_vector": embedding,
-            "k": 30,
-            "num_candidates": 100,
-        },
-        size=30,
-    )
 
+def similar_pairs(uuids: list[str], sources: np.ndarray, targets: np.ndarray,
+                  cosines: np.ndarray,
+                  threshold: float) -> dict[tuple[str, str], float]:
+    """Turn neighbor (row, row, cosine) triples into ordered pairs above threshold.
 
-async def process_one(uuid_1: str, es: AsyncElasticsearch, index: str,
-                      threshold: float):
-    embedding = await fetch_embedding(es, index, uuid_1)
-    if not embedding:
-        return uuid_1, []
+    Scores are stored as (1 + cosine) / 2, the scale Elasticsearch reports
+    cosine similarity in, which the API's thresholds are tuned for.
+    """
+    n = len(uuids)
+    scores = (1 + cosines) / 2
+    keep = scores >= threshold
+    # pairs are stored once, ordered, whichever side found them
+    keys = (np.minimum(sources, targets) * n + np.maximum(sources, targets))[keep]
+    scores = scores[keep]
+    order = np.lexsort((-scores, keys))
+    keys, scores = keys[order], scores[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return {(uuids[key // n], uuids[key % n]): float(score)
+            for key, score in zip(keys[first].tolist(), scores[first].tolist())}
 
-    res = await knn_search(es, index, embedding)
 
-    matches = []
-    for hit in res["hits"]["hits"]:
-        uuid_2 = hit["_id"]
-        score = hit["_score"]
+def load_neighbor_scores(db_connection: psycopg2.extensions.connection,
+                         uuids: list[str]) -> np.ndarray:
+    """Return the stored k-th neighbor cosine of each project.
 
-        if uuid_1 >= uuid_2:
-            continue
-        if score < threshold:
-            continue
+    Projects without one yet get +inf, so nothing is added to their lists
+    until the next full run.
+    """
+    with db_connection.cursor() as cur:
+        cur.execute("""
+            SELECT project_uuid, neighbor_score FROM project_digest
+            WHERE neighbor_score IS NOT NULL
+        """)
+        stored = dict(cur.fetchall())
+    return np.array([stored.get(uuid, np.inf) for uuid in uuids],
+                    dtype=np.float32)
 
-        matches.append((uuid_1, uuid_2, score))
 
-    return uuid_1, matches
+def load_pairs(db_connection: psycopg2.extensions.connection,
+               uuids: set[str]) -> list[tuple[str, str, float]]:
+    """Return the stored pairs involving any of `uuids`."""
+    with db_connection.cursor() as cur:
+        cur.execute("""
+            SELECT uuid_1, uuid_2, similarity_score FROM similarity
+            WHERE uuid_1 = ANY(%(uuids)s) OR uuid_2 = ANY(%(uuids)s)
+        """, {"uuids": list(uuids)})
+        return cur.fetchall()
+
+
+def write_neighbor_lists(cur: psycopg2.extensions.cursor,
+                         uuids: set[str] | None = None):
+    """Rebuild the neighbor lists of `uuids`, or all of them, from the pairs.
+
+    A list holds the best NEIGHBORS partners of a project in either
+    position of a pair, ordered by decreasing score.
+    """
+    params = {"all": uuids is None, "uuids": list(uuids or []), "n": NEIGHBORS}
+    cur.execute("""
+        DELETE FROM neighbors WHERE %(all)s OR project_uuid = ANY(%(uuids)s)
+    """, params)
+    cur.execute("""
+        INSERT INTO neighbors (project_uuid, neighbor_uuids, scores)
+        SELECT project_uuid,
+               (array_agg(other ORDER BY score DESC))[1:%(n)s],
+               (array_agg(score ORDER BY score DESC))[1:%(n)s]
+        FROM (
+            SELECT uuid_1 AS project_uuid, uuid_2 AS other,
+                   similarity_score AS score
+            FROM similarity
+            WHERE %(all)s OR uuid_1 = ANY(%(uuids)s)
+            UNION ALL
+            SELECT uuid_2, uuid_1, similarity_score
+            FROM similarity
+            WHERE %(all)s OR uuid_2 = ANY(%(uuids)s)
+        ) AS partners
+        GROUP BY project_uuid
+    """, params)
+
+
+def write_similarity(db_connection: psycopg2.extensions.connection,
+                     pairs: dict[tuple[str, str], float],
+                     neighbor_scores: dict[str, float],
+                     uuids: set[str] | None = None,
+                     affected: set[str] | None = None):
+    """Replace the pairs involving `uuids`, or all pairs, in one transaction.
+
+    The neighbor lists of the `affected` projects, or all lists, are
+    rebuilt in the same transaction.
+    """
+    with db_connection.cursor() as cur:
+        if uuids is None:
+            cur.execute("DELETE FROM similarity")
+        else:
+            cur.execute("""
+                DELETE FROM similarity
+                WHERE uuid_1 = ANY(%(uuids)s) OR uuid_2 = ANY(%(uuids)s)
+            """, {"uuids": list(uuids)})
+        execute_values(cur, """
+            INSERT INTO similarity (uuid_1, uuid_2, similarity_score)
+            VALUES %s
+            ON CONFLICT (uuid_1, uuid_2)
+            DO UPDATE SET similarity_score = EXCLUDED.similarity_score
+        """, [(a, b, score) for (a, b), score in pairs.items()],
+                       page_size=1000)
+        execute_values(cur, """
+            UPDATE project_digest d SET neighbor_score = v.neighbor_score
+            FROM (VALUES %s) AS v (project_uuid, neighbor_score)
+            WHERE d.project_uuid = v.project_uuid
+        """, list(neighbor_scores.items()), page_size=1000)
+        write_neighbor_lists(cur, affected)
+    db_connection.commit()
+
+
+def compute_similarity(
+        db_connection: psycopg2.extensions.connection,
+        threshold: float,
+        uuids: set[str] | None = None,
+        block_size: int = BLOCK_SIZE,
+        cancel: threading.Event | None = None
+) -> tuple[dict[tuple[str, str], float], dict[str, float], set[str] | None,
+           set[str] | None]:
+    """Find the similar pairs of all projects, or those involving `uuids`.
+
+    Neighbors are always searched in the whole corpus. For `uuids`, every
+    top-k list they are in, were in or now enter is recomputed as well,
+    and all pairs of the recomputed projects are replaced. A project
+    pushed out of a list by a changed one thus loses its pair, as in a
+    full run.
+
+    Returns the pairs, the k-th neighbor cosine of every recomputed list,
+    the projects whose pairs are replaced and the projects whose lists
+    changed (None for all).
+    """
+    started = time.perf_counter()
+    corpus, matrix = load_embedding_matrix(db_connection)
+    if uuids is None:
+        rows = np.arange(len(corpus))
+    else:
+        rows = np.array([i for i, uuid in enumerate(corpus) if uuid in uuids],
+                        dtype=np.int64)
+    replaced = affected = None
+
+    if uuids is not None:
+        kth = load_neighbor_scores(db_connection, corpus)
+        position = {uuid: i for i, uuid in enumerate(corpus)}
+        # the lists the changed projects now enter
+        stale = set(reverse_neighbors(matrix, rows, kth, block_size)[1].tolist())
+        # and the lists they were in, which may take in a new k-th neighbor
+        for uuid_1, uuid_2, score in load_pairs(db_connection, uuids):
+            for changed, other in ((uuid_1, uuid_2), (uuid_2, uuid_1)):
+                if changed not in uuids or other in uuids or other not in position:
+                    continue
+                if 2 * score - 1 >= kth[position[other]] - 1e-6:
+                    stale.add(position[other])
+        stale.difference_update(rows.tolist())
+        rows = np.concatenate([rows, np.array(sorted(stale), dtype=np.int64)])
+
+    neighbors, cosines = top_k(matrix, rows, block_size=block_size,
+                               cancel=cancel)
+    triples = [(np.repeat(rows, neighbors.shape[1]), neighbors.ravel(),
+                cosines.ravel())]
+
+    if uuids is not None:
+        if cosines.shape[1]:
+            kth[rows] = cosines[:, -1]
+        # the unchanged lists the recomputed projects belong in, k-th
+        # neighbors included, restore their pairs with the rest
+        triples.append(reverse_neighbors(matrix, rows, kth, block_size,
+                                         tolerance=1e-6))
+        replaced = set(uuids) | {corpus[row] for row in rows.tolist()}
+        affected = set(replaced)
+        for uuid_1, uuid_2, _ in load_pairs(db_connection, replaced):
+            affected.update((uuid_1, uuid_2))
+
+    pairs = similar_pairs(corpus, *(np.concatenate(arrays)
+                                    for arrays in zip(*triples)), threshold)
+    if affected is not None:
+        for uuid_1, uuid_2 in pairs:
+            affected.update((uuid_1, uuid_2))
+    neighbor_scores = {}
+    if cosines.shape[1]:
+        neighbor_scores = dict(zip((corpus[row] for row in rows.tolist()),
+                                   cosines[:, -1].tolist()))
+    print(f"Scored {len(rows)} of {len(corpus)} projects in "
+          f"{time.perf_counter() - started:.1f}s", flush=True)
+    return pairs, neighbor_scores, replaced, affected
 
 
 async def fill_similarity(
         db_connection: psycopg2.extensions.connection,
-        es: AsyncElasticsearch,
         threshold: float = 0.3,  # lowered threshold
-        batch_size: int = 50  # concurrency level
-):
-
-    cur = db_connection.cursor()
-    INDEX = "documents"
-
-    # sync DB fetch wrapped in async
-    projects = await asyncio.to_thread(lambda: (cur.execute(
-        "SELECT uuid FROM project ORDER BY uuid"), cur.fetchall())[1])
-
-    uuids = [row[0] for row in projects]
-    total_inserted = 0
-
-    # semaphore to limit ES pressure
-    sem = asyncio.Semaphore(10)
-
-    async def process_with_limit(uuid_1):
-        async with sem:
-            return await process_one(uuid_1, es, INDEX, threshold)
-
-    for start in range(0, len(uuids), batch_size):
-        batch = uuids[start:start + batch_size]
-
-        results = []
-        for uuid_1 in batch:
-            print(uuid_1)
-            result = await process_with_limit(uuid_1)
-            results.append(result)
-        # sync DB writes in a background thread
-        def write_to_db():
-            nonlocal total_inserted
-            for _, matches in results:
-                for uuid_1, uuid_2, score in matches:
-                    cur.execute(
-                        """
-                        INSERT INTO similarity (uuid_1, uuid_2, similarity_score)
-                        VALUES (%s, %s, %s)
-                        ON CONFLICT (uuid_1, uuid_2)
-                        DO UPDATE SET similarity_score = EXCLUDED.similarity_score
-                    """, (uuid_1, uuid_2, score))
-                    total_inserted += 1
-            db_connection.commit()
-
-        await asyncio.to_thread(write_to_db)
-
-        print(
-            f"Processed {start + len(batch)}/{len(uuids)} projects - stored {total_inserted}",
-            flush=True)
-
-    cur.close()
-    return total_inserted
+        uuids: set[str] | None = None  # only these projects, if given
+) -> tuple[int, set[str] | None]:
+    """Store the similar pairs among each project's TOP_K nearest neighbors,
+    and the neighbor lists built from them.
+
+    With `uuids`, only pairs involving those projects and the lists they
+    touch are replaced.
+    Returns the number of pairs written and the projects whose neighbor
+    lists changed, None meaning all.
+    """
+    cancel = threading.Event()
+    try:
+        pairs, neighbor_scores, replaced, affected = await asyncio.to_thread(
+            compute_similarity, db_connection, threshold, uuids, cancel=cancel)
+    except asyncio.CancelledError:
+        # the thread can't be interrupted, stop it at the next block
+        cancel.set()
+        raise
+    await asyncio.to_thread(write_similarity, db_connection, pairs,
+                            neighbor_scores, replaced, affected)
+    print(f"Stored {len(pairs)} similar pairs", flush=True)
+    return len(pairs), affected
@@ -0,0 +1,72 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+
+# off: no cache, record: serve fresh entries and store new responses,
+# replay: serve only from the cache and never touch the network
+CACHE_MODE = os.getenv("GRAPHQL_CACHE", "off")
+CACHE_DIR = os.getenv("GRAPHQL_CACHE_DIR", ".graphql_cache")
+
+# Seconds a recorded response stays fresh, per operation
+DEFAULT_TTL = {
+    "getPublishedHackathons": 60 * 60,
+    "GetPaginatedSubmittedProjects": 6 * 60 * 60,
+}
+
+
+class ResponseCache:
+    """On-disk, content-addressed cache of raw GraphQL responses.
+
+    Entries are keyed by operation name, variables and a hash of the query
+    text, and stored gzip-compressed under `directory`. In replay mode the
+    TTL is ignored, so a recorded crawl can be re-ingested indefinitely.
+    """
+
+    def __init__(self,
+                 directory: str = CACHE_DIR,
+                 replay: bool = False,
+                 ttl: dict[str, float] | None = None):
+        self.directory = directory
+        self.replay = replay
+        self.ttl = DEFAULT_TTL if ttl is None else ttl
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache | None":
+        if CACHE_MODE == "off":
+            return None
+        if CACHE_MODE not in ("record", "replay"):
+            raise ValueError(f"Unknown GRAPHQL_CACHE mode {CACHE_MODE!r}")
+        return cls(replay=CACHE_MODE == "replay")
+
+    def key(self, data: dict) -> str:
+        query_hash = hashlib.sha256(data["query"].encode()).hexdigest()
+        material = json.dumps(
+            [data["operationName"], data.get("variables", {}), query_hash],
+            sort_keys=True)
+        return hashlib.sha256(material.encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json.gz")
+
+    def get(self, data: dict) -> bytes | None:
+        """Return the recorded response body, or None on a miss."""
+        path = self._path(self.key(data))
+        try:
+            age = time.time() - os.path.getmtime(path)
+            if not self.replay and age > self.ttl.get(data["operationName"], 0):
+                return None
+            with gzip.open(path, "rb") as f:
+                return f.read()
+        except (FileNotFoundError, EOFError, gzip.BadGzipFile):
+            return None
+
+    def put(self, data: dict, body: bytes):
+        path = self._path(self.key(data))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write aside and rename so readers never see a partial entry
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp, "wb") as f:
+            f.write(body)
+        os.replace(tmp, path)
@@ -0,0 +1,70 @@
+import os
+import re
+
+import elasticsearch
+
+# Previous versions kept after a swap, to roll back to by moving the alias
+KEEP_VERSIONS = int(os.getenv("ES_KEEP_VERSIONS", "1"))
+
+
+def list_versions(es: elasticsearch.Elasticsearch, alias: str) -> list[int]:
+    """Return the version numbers of the alias's indices, oldest first."""
+    pattern = re.compile(rf"{re.escape(alias)}_v(\d+)")
+    names = es.indices.get(index=f"{alias}_v*", expand_wildcards="open")
+    return sorted(
+        int(match.group(1))
+        for match in map(pattern.fullmatch, names) if match)
+
+
+def live_index(es: elasticsearch.Elasticsearch, alias: str) -> str | None:
+    """Return the index the alias points to, or the legacy index of that name."""
+    if es.indices.exists_alias(name=alias):
+        return next(iter(es.indices.get_alias(name=alias)))
+    if es.indices.exists(index=alias):
+        return alias
+    return None
+
+
+def create_version(es: elasticsearch.Elasticsearch, alias: str,
+                   mapping: dict, settings: dict | None = None) -> str:
+    """Create the next, empty version of the alias's index."""
+    versions = list_versions(es, alias)
+    index = f"{alias}_v{versions[-1] + 1 if versions else 1}"
+    es.indices.create(index=index, body={**mapping, "settings": settings or {}})
+    return index
+
+
+def swap_alias(es: elasticsearch.Elasticsearch, alias: str, index: str):
+    """Point the alias at index in one atomic step.
+
+    An index created before versioning took the alias's name; it is dropped
+    in the same step, since an alias can't share a name with an index.
+    """
+    current = live_index(es, alias)
+    if current == alias:
+        actions = [{"remove_index": {"index": alias}}]
+    elif current:
+        actions = [{"remove": {"index": current, "alias": alias}}]
+    else:
+        actions = []
+    actions.append({"add": {"index": index, "alias": alias}})
+    es.indices.update_aliases(actions=actions)
+
+
+def gc_versions(es: elasticsearch.Elasticsearch, alias: str,
+                keep: int = KEEP_VERSIONS) -> list[str]:
+    """Delete all but the live version and the `keep` versions before it.
+
+    Versions newer than the live one belong to a rebuild in progress, or one
+    that failed validation, and are left alone.
+    """
+    current = live_index(es, alias)
+    versions = list_versions(es, alias)
+    if current is None or current == alias:
+        return []
+    live = int(current.rsplit("_v", 1)[1])
+    older = [version for version in versions if version < live]
+    stale = [f"{alias}_v{version}" for version in older[:max(len(older) - keep, 0)]]
+    for index in stale:
+        es.indices.delete(index=index, ignore_unavailable=True)
+    return stale
@@ -0,0 +1,119 @@
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+import traceback
+
+# How often the loop is probed, and the lag counted as a stall (seconds)
+INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.05"))
+THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", "0.1"))
+# Stalls kept for the metrics endpoint
+RECENT = int(os.getenv("LOOP_LAG_RECENT", "50"))
+
+_APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _call_site(frame) -> str:
+    """Describe the innermost application frame of a stack.
+
+    Library frames are skipped, since a stall inside psycopg2 or the ES
+    client is caused by the code that called it.
+    """
+    stack = traceback.extract_stack(frame)
+    for entry in reversed(stack):
+        path = os.path.abspath(entry.filename)
+        if path.startswith(_APP_DIR) and f"{os.sep}.venv{os.sep}" not in path:
+            return f"{os.path.relpath(path, _APP_DIR)}:{entry.lineno} in {entry.name}"
+    entry = stack[-1]
+    return f"{entry.filename}:{entry.lineno} in {entry.name}"
+
+
+class LoopMonitor:
+    """Measures event-loop lag and records where the loop was stuck.
+
+    A task on the loop sleeps INTERVAL at a time and counts any extra
+    delay as lag. A watchdog thread samples the loop thread's stack once
+    a tick is overdue by THRESHOLD, which names the blocking call while
+    it is still running.
+    """
+
+    def __init__(self, interval: float = INTERVAL,
+                 threshold: float = THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = 0
+        self.stalled_seconds = 0.0
+        self.max_stall = 0.0
+        self.max_lag = 0.0
+        self.sites = collections.Counter()
+        self.site_seconds = collections.Counter()
+        self.recent = collections.deque(maxlen=RECENT)
+        self._tick = time.monotonic()
+        self._site = None
+        self._loop_thread = None
+        self._task = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start monitoring the running loop."""
+        self._loop_thread = threading.get_ident()
+        self._tick = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._probe())
+        threading.Thread(target=self._watch, name="loop-monitor",
+                         daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _probe(self):
+        while True:
+            self._tick = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - self._tick - self.interval
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self._record(lag)
+            self._site = None
+
+    def _watch(self):
+        while not self._stop.wait(self.interval / 2):
+            overdue = time.monotonic() - self._tick - self.interval
+            if overdue >= self.threshold and self._site is None:
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    self._site = _call_site(frame)
+
+    def _record(self, lag: float):
+        site = self._site or "unknown"
+        self.stalls += 1
+        self.stalled_seconds += lag
+        self.max_stall = max(self.max_stall, lag)
+        self.sites[site] += 1
+        self.site_seconds[site] += lag
+        self.recent.append({"at": time.time(), "seconds": round(lag, 4),
+                            "site": site})
+        print(f"Event loop stalled for {lag * 1000:.0f}ms at {site}",
+              flush=True)
+
+    def stats(self) -> dict:
+        return {
+            "interval_seconds": self.interval,
+            "threshold_seconds": self.threshold,
+            "stalls": self.stalls,
+            "stalled_seconds": round(self.stalled_seconds, 4),
+            "max_stall_seconds": round(self.max_stall, 4),
+            "max_lag_seconds": round(self.max_lag, 4),
+            "sites": [{
+                "site": site,
+                "stalls": count,
+                "seconds": round(self.site_seconds[site], 4)
+            } for site, count in self.sites.most_common(20)],
+            "recent": list(self.recent),
+        }
+
+
+monitor = LoopMonitor()
@@ -0,0 +1,232 @@
+import collections
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable
+
+import psycopg2
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+
+# Bytes of encoded responses kept per process; 0 disables the cache
+MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Responses larger than this are never cached
+MAX_ENTRY_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRY_BYTES",
+                                str(8 * 1024 * 1024)))
+# Seconds a read of the content generation is trusted before checking again
+GENERATION_TTL = float(os.getenv("RESPONSE_CACHE_GENERATION_TTL", "2"))
+# Optional SQLite file shared by the workers on this host, and its size bound
+SHARED_PATH = os.getenv("RESPONSE_CACHE_PATH", "")
+SHARED_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_SHARED_MAX_BYTES",
+                                 str(256 * 1024 * 1024)))
+
+
+def _read_generation(db_connection: psycopg2.extensions.connection) -> int | None:
+    try:
+        with db_connection.cursor() as cur:
+            cur.execute(
+                "SELECT last_value, is_called FROM content_generation")
+            last_value, is_called = cur.fetchone()
+    except psycopg2.Error as e:
+        if not db_connection.autocommit:
+            db_connection.rollback()
+        print(f"Could not read the content generation: {e}")
+        return None
+    return last_value if is_called else 0
+
+
+class SharedStore:
+    """Encoded responses in a SQLite file, so workers reuse each other's."""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS response (
+                    key TEXT PRIMARY KEY,
+                    generation INTEGER NOT NULL,
+                    body BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    used_at REAL NOT NULL
+                )
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS response_used_at_idx "
+                "ON response (used_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str, generation: int) -> bytes | None:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT body FROM response WHERE key = ? AND generation = ?",
+                (key, generation)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE response SET used_at = ? WHERE key = ?",
+                             (time.time(), key))
+        return None if row is None else row[0]
+
+    def put(self, key: str, generation: int, body: bytes):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?)",
+                (key, generation, body, len(body), time.time()))
+            total = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM response").fetchone()[0]
+            # drop the least recently used rows until under the bound
+            for old_key, size in conn.execute(
+                    "SELECT key, size FROM response ORDER BY used_at").fetchall():
+                if total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM response WHERE key = ?", (old_key,))
+                total -= size
+
+    def purge(self, generation: int):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM response WHERE generation < ?",
+                         (generation,))
+
+
+class ResponseCache:
+    """LRU of encoded JSON responses, valid for one content generation.
+
+    Entries are kept as the exact bytes sent, so a hit skips both the
+    queries and the JSON encoding, and the size bound counts real bytes.
+    The whole cache is dropped when the content generation moves on.
+    """
+
+    def __init__(self, max_bytes: int = MAX_BYTES,
+                 shared: SharedStore | None = None):
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.size = 0
+        self._entries = collections.OrderedDict()
+        self._generation = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def generation(self, db_connection: psycopg2.extensions.connection) -> int | None:
+        """The current content generation, read at most every GENERATION_TTL."""
+        now = time.monotonic()
+        if now - self._checked_at < GENERATION_TTL:
+            return self._generation
+        generation = _read_generation(db_connection)
+        with self._lock:
+            self._checked_at = now
+            if generation != self._generation:
+                if self._entries:
+                    self.invalidations += 1
+                self._entries.clear()
+                self.size = 0
+                self._generation = generation
+                if self.shared is not None and generation is not None:
+                    self.shared.purge(generation)
+        return generation
+
+    def _get(self, key: str) -> bytes | None:
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+        return body
+
+    def _put(self, key: str, generation: int, body: bytes):
+        with self._lock:
+            # the generation moved on while this response was being built
+            if generation != self._generation or key in self._entries:
+                return
+            self._entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def get_or_compute(self, db_connection: psycopg2.extensions.connection,
+                       key: str, compute: Callable[[], object]) -> Response:
+        """Serve `key` from the cache, or compute, encode and cache it."""
+        if self.max_bytes <= 0:
+            return JSONResponse(jsonable_encoder(compute()))
+        generation = self.generation(db_connection)
+        if generation is None:
+            self.bypassed += 1
+            return JSONResponse(jsonable_encoder(compute()))
+
+        body = self._get(key)
+        if body is not None:
+            self.hits += 1
+            return Response(body, media_type="application/json")
+        if self.shared is not None:
+            body = self.shared.get(key, generation)
+            if body is not None:
+                self.shared_hits += 1
+                self._put(key, generation, body)
+                return Response(body, media_type="application/json")
+
+        self.misses += 1
+        response = JSONResponse(jsonable_encoder(compute()))
+        if len(response.body) <= MAX_ENTRY_BYTES:
+            self._put(key, generation, response.body)
+            if self.shared is not None:
+                self.shared.put(key, generation, response.body)
+        return response
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.shared_hits + self.misses
+        return {
+            "generation": self._generation,
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_ratio": round((self.hits + self.shared_hits) / lookups, 4)
+                         if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "shared": self.shared.path if self.shared is not None else None,
+        }
+
+
+def _normalize_terms(values: list[str] | None) -> list[str] | None:
+    return sorted(set(values)) if values else None
+
+
+def cache_key(endpoint: str, **params) -> str:
+    """A stable key for `params`.
+
+    Filter lists are sorted and deduplicated and empty values left out,
+    which the handlers treat alike, so equivalent requests share an entry.
+    """
+    normalized = {}
+    for name, value in params.items():
+        if isinstance(value, list):
+            value = _normalize_terms(value)
+        elif isinstance(value, str):
+            value = value or None
+        if value is not None:
+            normalized[name] = value
+    return f"{endpoint}:{json.dumps(normalized, sort_keys=True)}"
+
+
+response_cache = ResponseCache(
+    shared=SharedStore(SHARED_PATH, SHARED_MAX_BYTES) if SHARED_PATH else None)
@@ -0,0 +1,151 @@
+import dataclasses
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+import psycopg2
+
+from ._embeddings import DIMS, MODEL
+from ._fill_similarity import load_embedding_matrix
+
+# Directory of the published snapshots and of the CURRENT pointer to one
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", ".snapshots")
+# Seconds between checks for a newer snapshot
+POLL_INTERVAL = float(os.getenv("SNAPSHOT_POLL_INTERVAL", "5"))
+# Snapshots kept besides the current one, for workers still mapping them
+KEEP_SNAPSHOTS = int(os.getenv("SNAPSHOT_KEEP", "1"))
+
+
+@dataclasses.dataclass(frozen=True)
+class Snapshot:
+    """Read-only, memory-mapped embeddings of one ingest generation.
+
+    Rows of `matrix` are normalized and ordered like the sorted `uuids`,
+    which are fixed-width bytes so both can be mapped without copying.
+    """
+    generation: int
+    model: str
+    uuids: np.ndarray
+    matrix: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.uuids)
+
+    def row(self, uuid: str) -> int | None:
+        key = uuid.encode()
+        i = int(np.searchsorted(self.uuids, key))
+        if i < len(self.uuids) and self.uuids[i] == key:
+            return i
+        return None
+
+    def uuid(self, row: int) -> str:
+        return self.uuids[row].decode()
+
+    def vector(self, uuid: str) -> np.ndarray | None:
+        row = self.row(uuid)
+        return None if row is None else self.matrix[row]
+
+
+def publish_snapshot(db_connection: psycopg2.extensions.connection,
+                     generation: int,
+                     directory: str = SNAPSHOT_DIR) -> int:
+    """Write the indexed embeddings as snapshot `generation` and switch to it.
+
+    The snapshot is written to a temporary directory and renamed into place
+    before CURRENT is replaced, so readers never see a partial one.
+    Returns the number of vectors.
+    """
+    uuids, matrix = load_embedding_matrix(db_connection)
+    os.makedirs(directory, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=directory, prefix=".staging-")
+    try:
+        np.save(os.path.join(staging, "embeddings.npy"), matrix)
+        np.save(os.path.join(staging, "uuids.npy"),
+                np.array([uuid.encode() for uuid in uuids], dtype=bytes))
+        with open(os.path.join(staging, "meta.json"), "w") as f:
+            json.dump({"generation": generation, "model": MODEL,
+                       "dims": DIMS, "count": len(uuids)}, f)
+        target = os.path.join(directory, str(generation))
+        shutil.rmtree(target, ignore_errors=True)
+        os.rename(staging, target)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    _write_atomic(os.path.join(directory, "CURRENT"), str(generation))
+    _remove_old(directory, generation)
+    return len(uuids)
+
+
+def _write_atomic(path: str, content: str):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def _remove_old(directory: str, current: int):
+    generations = sorted(
+        int(name) for name in os.listdir(directory) if name.isdigit())
+    older = [generation for generation in generations if generation < current]
+    # mapped files stay readable after unlinking, so workers aren't disturbed
+    for generation in older[:max(len(older) - KEEP_SNAPSHOTS, 0)]:
+        shutil.rmtree(os.path.join(directory, str(generation)),
+                      ignore_errors=True)
+
+
+def load_snapshot(directory: str = SNAPSHOT_DIR) -> Snapshot | None:
+    """Map the current snapshot, or return None if there is none."""
+    try:
+        with open(os.path.join(directory, "CURRENT")) as f:
+            generation = int(f.read())
+    except FileNotFoundError:
+        return None
+    path = os.path.join(directory, str(generation))
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    return Snapshot(
+        generation=meta["generation"],
+        model=meta["model"],
+        uuids=np.load(os.path.join(path, "uuids.npy"), mmap_mode="r"),
+        matrix=np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r"))
+
+
+_current: Snapshot | None = None
+_checked_at = 0.0
+_pointer_mtime = None
+_lock = threading.Lock()
+
+
+def current_snapshot(directory: str = SNAPSHOT_DIR) -> Snapshot | None:
+    """Return the latest snapshot, mapping a newer one when it is published.
+
+    The CURRENT pointer is checked at most every POLL_INTERVAL seconds, so
+    every worker process picks up new generations without a restart.
+    """
+    global _current, _checked_at, _pointer_mtime
+    now = time.monotonic()
+    if now - _checked_at < POLL_INTERVAL:
+        return _current
+    with _lock:
+        if now - _checked_at < POLL_INTERVAL:
+            return _current
+        _checked_at = now
+        try:
+            mtime = os.stat(os.path.join(directory, "CURRENT")).st_mtime_ns
+        except FileNotFoundError:
+            return _current
+        if mtime != _pointer_mtime:
+            try:
+                snapshot = load_snapshot(directory)
+            except (OSError, ValueError) as e:
+                print(f"Failed to load embedding snapshot: {e}")
+            else:
+                _current, _pointer_mtime = snapshot, mtime
+                if snapshot is not None:
+                    print(f"Mapped embedding snapshot {snapshot.generation} "
+                          f"({len(snapshot)} vectors)", flush=True)
+    return _current
@@ -0,0 +1,89 @@
+import datetime
+import hashlib
+import os
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from ._fill_db import content_hash
+
+# A hackathon whose projects have not changed for this many days is closed
+SETTLED_DAYS = int(os.getenv("SYNC_SETTLED_DAYS", "30"))
+# Closed hackathons are only downloaded again after this many days
+RECHECK_DAYS = int(os.getenv("SYNC_RECHECK_DAYS", "7"))
+
+
+class EventDigest:
+    """Order-independent digest over the downloaded projects of one event.
+
+    Projects are hashed with fill_db's content hash, so a change to media
+    URLs alone, which the links refresh keeps up to date, doesn't make an
+    event look changed.
+    """
+
+    def __init__(self):
+        self.hashes: dict[str, str] = {}
+
+    def update(self, projects: list[dict]):
+        for project in projects:
+            self.hashes[project["uuid"]] = content_hash(project)
+
+    def hexdigest(self) -> str:
+        digest = hashlib.sha256()
+        for uuid in sorted(self.hashes):
+            digest.update(f"{uuid}:{self.hashes[uuid]}\n".encode())
+        return digest.hexdigest()
+
+
+def load_sync_state(
+        db_connection: psycopg2.extensions.connection) -> dict[str, dict]:
+    """Return the watermark of every known event, keyed by slug."""
+    with db_connection.cursor() as cur:
+        cur.execute("""
+            SELECT event_slug, last_synced_at, last_changed_at,
+                   project_count, digest
+            FROM sync_state
+        """)
+        columns = [desc[0] for desc in cur.description]
+        return {row[0]: dict(zip(columns, row)) for row in cur.fetchall()}
+
+
+def needs_sync(state: dict | None, now: datetime.datetime) -> bool:
+    """Whether an event has to be downloaded in this run."""
+    if state is None:
+        return True
+    if now - state["last_changed_at"] < datetime.timedelta(days=SETTLED_DAYS):
+        return True
+    return now - state["last_synced_at"] >= datetime.timedelta(
+        days=RECHECK_DAYS)
+
+
+def is_changed(state: dict | None, digest: EventDigest) -> bool:
+    return state is None or state["digest"] != digest.hexdigest()
+
+
+def save_sync_state(db_connection: psycopg2.extensions.connection,
+                    states: dict[str, dict], digests: dict[str, EventDigest],
+                    now: datetime.datetime) -> int:
+    """Store the watermarks of the events downloaded in this run."""
+    rows = []
+    for slug, digest in digests.items():
+        state = states.get(slug)
+        changed_at = now if is_changed(state, digest) else state["last_changed_at"]
+        rows.append((slug, now, changed_at, len(digest.hashes),
+                     digest.hexdigest()))
+
+    with db_connection.cursor() as cur:
+        execute_values(
+            cur, """
+            INSERT INTO sync_state (event_slug, last_synced_at, last_changed_at,
+                                    project_count, digest)
+            VALUES %s
+            ON CONFLICT (event_slug) DO UPDATE
+            SET last_synced_at = EXCLUDED.last_synced_at,
+                last_changed_at = EXCLUDED.last_changed_at,
+                project_count = EXCLUDED.project_count,
+                digest = EXCLUDED.digest
+        """, rows)
+    db_connection.commit()
+    return len(rows)
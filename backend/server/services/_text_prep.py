@@ -0,0 +1,77 @@
+import asyncio
+import concurrent.futures
+import functools
+import multiprocessing
+import os
+
+import tiktoken
+
+MAX_TOKENS = 8000
+# Worker processes tokenizing texts, and texts handed to a worker at once.
+# Each spawned worker imports the entry script again, so keep this small
+WORKERS = int(os.getenv("TEXT_PREP_WORKERS", "2"))
+BATCH_SIZE = int(os.getenv("TEXT_PREP_BATCH_SIZE", "200"))
+
+_pool: concurrent.futures.ProcessPoolExecutor | None = None
+
+
+@functools.cache
+def _encoding() -> tiktoken.Encoding:
+    """The tokenizer, loaded once per process.
+
+    This is the OpenAI embedding models' encoding; other providers truncate
+    to their own limit on top of it.
+    """
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def shorten_text(text: str) -> tuple[str, int]:
+    """Truncate text to the embedding model's limit, with its token count."""
+    encoding = _encoding()
+    tokens = encoding.encode(text)
+    if len(tokens) > MAX_TOKENS:
+        truncated_tokens = tokens[:MAX_TOKENS]
+        return encoding.decode(truncated_tokens), MAX_TOKENS
+    return text, len(tokens)
+
+
+def _prepare_batch(
+        items: list[tuple[str, str]]) -> list[tuple[str, str, int]]:
+    return [(uuid, *shorten_text(text)) for uuid, text in items]
+
+
+def _get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn, since forking a process that runs threads is unsafe
+        _pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=WORKERS,
+            mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+async def prepare_texts(
+        items: list[tuple[str, str]]) -> list[tuple[str, str, int]]:
+    """Tokenize and truncate (uuid, text) items on the process pool.
+
+    Returns (uuid, text, token_count) records, in input order, for the
+    embedding stage. The event loop only waits; it never tokenizes.
+    """
+    loop = asyncio.get_running_loop()
+    pool = _get_pool()
+    try:
+        batches = await asyncio.gather(*(
+            loop.run_in_executor(pool, _prepare_batch, items[start:start + BATCH_SIZE])
+            for start in range(0, len(items), BATCH_SIZE)))
+    except concurrent.futures.process.BrokenProcessPool:
+        # a crashed worker breaks the pool for good, start a new one next time
+        shutdown_pool()
+        raise
+    return [record for batch in batches for record in batch]
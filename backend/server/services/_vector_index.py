@@ -0,0 +1,83 @@
+import asyncio
+import os
+
+import elasticsearch
+import numpy as np
+
+from ._embeddings import MODEL
+from ._snapshot import Snapshot, current_snapshot
+
+# Where query kNN runs: "es" for the index's HNSW, "local" for an exact
+# search over the mapped embedding snapshot in the API process
+VECTOR_SEARCH = os.getenv("VECTOR_SEARCH", "es")
+
+
+def local_search(snapshot: Snapshot, embedding: list[float],
+                 k: int) -> list[tuple[str, float]]:
+    """Exact cosine kNN over the snapshot.
+
+    Scores are (1 + cosine) / 2 like Elasticsearch's, so both paths can
+    be swapped without changing thresholds.
+    """
+    query = np.asarray(embedding, dtype=np.float32)
+    if len(snapshot) == 0 or query.shape != snapshot.matrix.shape[1:]:
+        return []
+    query /= max(float(np.linalg.norm(query)), 1e-12)
+    cosines = snapshot.matrix @ query
+    k = min(k, len(cosines))
+    top = np.argpartition(-cosines, k - 1)[:k]
+    top = top[np.argsort(-cosines[top])]
+    return [(snapshot.uuid(row), float((1 + cosines[row]) / 2))
+            for row in top.tolist()]
+
+
+def _knn_body(embedding: list[float], k: int, num_candidates: int) -> dict:
+    return {
+        "knn": {
+            "field": "embedding",
+            "query_vector": embedding,
+            "k": k,
+            "num_candidates": num_candidates,
+        },
+        "size": k,
+        "source": False,
+    }
+
+
+def es_search(es: elasticsearch.Elasticsearch, index: str,
+              embedding: list[float], k: int,
+              num_candidates: int) -> list[tuple[str, float]]:
+    res = es.search(index=index, **_knn_body(embedding, k, num_candidates))
+    return [(hit["_id"], hit["_score"]) for hit in res["hits"]["hits"]]
+
+
+async def es_search_async(es: elasticsearch.AsyncElasticsearch, index: str,
+                          embedding: list[float], k: int,
+                          num_candidates: int) -> list[tuple[str, float]]:
+    res = await es.search(index=index,
+                          **_knn_body(embedding, k, num_candidates))
+    return [(hit["_id"], hit["_score"]) for hit in res["hits"]["hits"]]
+
+
+def _local_snapshot() -> Snapshot | None:
+    if VECTOR_SEARCH == "local":
+        snapshot = current_snapshot()
+        if snapshot is not None and snapshot.model == MODEL:
+            return snapshot
+    return None
+
+
+async def knn_search_async(es: elasticsearch.AsyncElasticsearch, index: str,
+                           embedding: list[float], k: int,
+                           num_candidates: int) -> list[tuple[str, float]]:
+    """Return the k nearest (uuid, score) pairs, best first.
+
+    Runs in process when VECTOR_SEARCH is "local" and a snapshot of the
+    current model is mapped, and falls back to Elasticsearch otherwise.
+    The exact scan runs in a thread: it takes tens of milliseconds on a
+    large snapshot, more while its pages are faulted in.
+    """
+    snapshot = _local_snapshot()
+    if snapshot is not None:
+        return await asyncio.to_thread(local_search, snapshot, embedding, k)
+    return await es_search_async(es, index, embedding, k, num_candidates)
@@ -1,4 +1,5 @@
 import asyncio
+import datetime
 import elasticsearch
 import psycopg2
 import json
@@ -6,61 +7,160 @@ import os
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from openai import AsyncOpenAI
-from ._download import download_links, download_projects, download_hackathons
-from ._fill_db import fill_db, fill_db_links
-from ._fill_search import fill_search
+from ._db_pool import ConnectionPool
+from ._download import download_events, download_hackathons, download_links, open_session
+from ._fill_db import (begin_ingest, bump_generation, dirty_projects, fill_db,
+                       fill_db_links, finish_ingest)
+from ._fill_search import fill_search, needs_rebuild, rebuild_search
 from ._fill_similarity import fill_similarity
+from ._snapshot import load_snapshot, publish_snapshot
+from ._sync_state import (EventDigest, load_sync_state, needs_sync,
+                          save_sync_state)
+from ._text_prep import shutdown_pool
 
 scheduler = AsyncIOScheduler()
 
 
+def _invalidate_responses(db: psycopg2.extensions.connection):
+    # a failed stage leaves its transaction aborted, and uncommitted
+    # changes are never served
+    db.rollback()
+    bump_generation(db)
+
+
 async def update_projects(db: psycopg2.extensions.connection,
                           es: elasticsearch.Elasticsearch,
-                          openai_client: AsyncOpenAI):
-    hackathons = await download_hackathons()
-    additional = ["trifecta-tee", "trifecta-zk", "trifecta-agents"]
-    hackathons.extend([{"slug": h} for h in additional])
-    for h in hackathons:
-        print(h)
-        projects = await download_projects(h["slug"])
-        print(f"Downloaded {len(projects)} projects for hackathon {h['slug']}")
-        if len(projects) > 0:
-            count = fill_db(db, projects)
-            print(f"Successfully loaded {count} projects into the database!")
-    print("Filling search", flush=True)
-    count = await fill_search(db, es, openai_client)
-    print(f"Successfully loaded {count} projects into Elasticsearch!")
-    print("Filling similarity", flush=True)
-    similarity_count = await fill_similarity(db, es)
-    print(f"Successfully loaded {similarity_count} similarities into the database!")
+                          openai_client: AsyncOpenAI,
+                          force: bool = False,
+                          rebuild: bool = False):
+    """Sync changed hackathons into Postgres, Elasticsearch and similarity.
+
+    With `force`, every hackathon is downloaded and re-indexed regardless of
+    its watermark. Replaying from the GraphQL cache always forces.
+    Otherwise only projects whose content hash changed are re-indexed.
+    With `rebuild`, or when the index mapping changed, the search index is
+    rebuilt into a new version and swapped in once complete.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    states = await asyncio.to_thread(load_sync_state, db)
+    generation = await asyncio.to_thread(begin_ingest, db)
+    try:
+        digests = {}
+        written = False
+        async with open_session() as session:
+            force = force or (session.cache is not None and session.cache.replay)
+            hackathons = await download_hackathons(session)
+            additional = ["trifecta-tee", "trifecta-zk", "trifecta-agents"]
+            hackathons.extend([{"slug": h} for h in additional])
+            # closed hackathons are skipped until their next recheck
+            slugs = [
+                h["slug"] for h in hackathons
+                if force or needs_sync(states.get(h["slug"]), now)
+            ]
+            print(f"Syncing {len(slugs)} of {len(hackathons)} hackathons")
+            digests = {slug: EventDigest() for slug in slugs}
+            async for slug, page in download_events(session, slugs):
+                digests[slug].update(page)
+                if len(page) > 0:
+                    # write in a thread so the downloads keep going meanwhile
+                    count = await asyncio.to_thread(fill_db, db, page, generation)
+                    written = True
+                    print(f"Loaded {count} projects of hackathon {slug} "
+                          f"({len(digests[slug].hashes)} so far)")
+
+        # the new rows are served while the later stages run
+        if written:
+            await asyncio.to_thread(bump_generation, db)
+
+        # a failed hackathon keeps its old watermark and is retried next run
+        for slug, error in session.failures.items():
+            print(f"Hackathon {slug} failed and will be retried: {error}")
+            del digests[slug]
+
+        # None means every project
+        dirty = None if force else await asyncio.to_thread(dirty_projects, db)
+        if dirty is not None:
+            print(f"{len(dirty)} changed projects need indexing")
+
+        rebuilt = False
+        try:
+            if rebuild or await asyncio.to_thread(needs_rebuild, es):
+                rebuilt = await rebuild_search(db, es, openai_client)
+
+            if dirty is None or dirty:
+                if not rebuilt:
+                    print("Filling search", flush=True)
+                    count = await fill_search(db, es, openai_client, uuids=dirty)
+                    print(f"Successfully loaded {count} projects into Elasticsearch!")
+        finally:
+            # the tokenizer workers are idle until the next run
+            await asyncio.to_thread(shutdown_pool)
+
+        # API workers map the indexed vectors from a snapshot of this generation
+        if (dirty is None or dirty or rebuilt
+                or await asyncio.to_thread(load_snapshot) is None):
+            count = await asyncio.to_thread(publish_snapshot, db, generation)
+            print(f"Published embedding snapshot {generation} with {count} vectors")
+
+        if dirty is None or dirty:
+            print("Filling similarity", flush=True)
+            similarity_count, affected = await fill_similarity(db, uuids=dirty)
+            print(f"Successfully loaded {similarity_count} similarities into the database!")
+            if affected is not None:
+                print(f"Neighbor lists of {len(affected)} projects changed")
+
+        # only advance the watermarks once every stage has seen the changes
+        await asyncio.to_thread(save_sync_state, db, states, digests, now)
+        await asyncio.to_thread(finish_ingest, db, generation)
+    finally:
+        # Postgres holds this run's pages even when a later stage failed,
+        # so cached API responses are outdated either way
+        await asyncio.to_thread(_invalidate_responses, db)
 
 
 async def update_links(db: psycopg2.extensions.connection,
                        es: elasticsearch.Elasticsearch):
     print("Updating links", flush=True)
-    links = await download_links()
-    print(f"Downloaded {len(links)} links")
-    fill_db_links(db, links)
-    print(f"Successfully loaded {len(links)} links into the database!")
+    updated = skipped = 0
+    async with open_session() as session:
+        async for page in download_links(session):
+            page_updated, page_skipped = await asyncio.to_thread(
+                fill_db_links, db, page)
+            updated += page_updated
+            skipped += page_skipped
+    print(f"Updated links of {updated} projects, "
+          f"skipped {skipped} unchanged")
+    if updated:
+        await asyncio.to_thread(bump_generation, db)
+
+
+async def _with_connection(job, db_pool: ConnectionPool, *args):
+    """Run an ingest job on a connection checked out for its duration."""
+    db = await asyncio.to_thread(db_pool.acquire)
+    try:
+        await job(db, *args)
+    finally:
+        db_pool.release(db)
 
 
-async def start_scheduler(db: psycopg2.extensions.connection,
+async def start_scheduler(db_pool: ConnectionPool,
                           es: elasticsearch.Elasticsearch,
                           openai_client: AsyncOpenAI):
     if os.getenv("NO_UPDATE", "false") == "false":
-        asyncio.create_task(update_projects(db, es, openai_client))
-        scheduler.add_job(update_projects,
+        asyncio.create_task(
+            _with_connection(update_projects, db_pool, es, openai_client))
+        scheduler.add_job(_with_connection,
                         "interval",
                         minutes=60*24,
-                        args=[db, es, openai_client])
-        scheduler.add_job(update_links,
+                        args=[update_projects, db_pool, es, openai_client])
+        scheduler.add_job(_with_connection,
                         "interval",
                         minutes=25,
-                        args=[db, es])
+                        args=[update_links, db_pool, es])
     else:
-        asyncio.create_task(update_links(db, es))
-        scheduler.add_job(update_links,
+        asyncio.create_task(_with_connection(update_links, db_pool, es))
+        scheduler.add_job(_with_connection,
                         "interval",
                         minutes=50,
-                        args=[db, es])
+                        args=[update_links, db_pool, es])
     scheduler.start()
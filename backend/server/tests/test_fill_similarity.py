@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from services import _fill_similarity
+
+THRESHOLD = 0.6
+
+
+class Store:
+    """The similarity and neighbor_score columns, kept in memory."""
+
+    def __init__(self, uuids: list[str], matrix: np.ndarray):
+        self.uuids = uuids
+        self.matrix = matrix
+        self.pairs = {}
+        self.kth = {}
+
+    def load_embedding_matrix(self, db_connection):
+        norms = np.linalg.norm(self.matrix, axis=1, keepdims=True)
+        return list(self.uuids), self.matrix / np.maximum(norms, 1e-12)
+
+    def load_neighbor_scores(self, db_connection, uuids):
+        return np.array([self.kth.get(uuid, np.inf) for uuid in uuids],
+                        dtype=np.float32)
+
+    def load_pairs(self, db_connection, uuids):
+        return [(a, b, score) for (a, b), score in self.pairs.items()
+                if a in uuids or b in uuids]
+
+    def write(self, pairs, neighbor_scores, replaced):
+        # as write_similarity does
+        if replaced is None:
+            self.pairs = {}
+        else:
+            self.pairs = {(a, b): score for (a, b), score in self.pairs.items()
+                          if a not in replaced and b not in replaced}
+        self.pairs.update(pairs)
+        self.kth.update(neighbor_scores)
+
+    def run(self, uuids=None):
+        pairs, neighbor_scores, replaced, _ = _fill_similarity.compute_similarity(
+            None, THRESHOLD, uuids, block_size=64)
+        self.write(pairs, neighbor_scores, replaced)
+
+
+@pytest.fixture
+def store(monkeypatch):
+    rng = np.random.default_rng(7)
+    uuids = [f"p{i:04d}" for i in range(300)]
+    store = Store(uuids, rng.standard_normal((300, 16)).astype(np.float32))
+    for name in ("load_embedding_matrix", "load_neighbor_scores", "load_pairs"):
+        monkeypatch.setattr(_fill_similarity, name, getattr(store, name))
+    return store
+
+
+def test_incremental_rounds_match_full_recompute(store):
+    rng = np.random.default_rng(11)
+    store.run()
+    for _ in range(5):
+        changed = rng.choice(len(store.uuids), size=12, replace=False)
+        # move the changed projects toward others, so they enter and leave lists
+        others = rng.choice(len(store.uuids), size=len(changed))
+        store.matrix[changed] = (0.3 * store.matrix[changed]
+                                 + store.matrix[others])
+        store.run({store.uuids[i] for i in changed.tolist()})
+
+    incremental = store.pairs
+    store.run()
+    assert incremental.keys() == store.pairs.keys()
+    for key, score in store.pairs.items():
+        assert incremental[key] == pytest.approx(score, abs=1e-6)